@@ -43,6 +43,7 @@ import wx.lib.scrolledpanel as scr
 import matplotlib as mpl
 from matplotlib.backends.backend_wxagg import FigureCanvasWxAgg as FigureCanvas
 from matplotlib.backends.backend_wxagg import NavigationToolbar2WxAgg as NavigationToolbar
+from matplotlib.collections import LineCollection
 
 # Ordered dictionary
 from collections import OrderedDict as odict
@@ -50,9 +51,15 @@ from collections import OrderedDict as odict
 # OS operations for exception-free file checking
 import os.path
 
+# For loading STEP files in background
+import threading
+
 # Import networkx for plotting lattice
 import networkx as nx
 
+# For lattice node colours
+import numpy as np
+
 # Gets rid of blurring throughout application by getting DPI info
 import ctypes
 try:
@@ -61,7 +68,7 @@ except:
     pass
 
 # For STEP import
-from step_parse_5_2 import StepParse
+from step_parse_5_2 import StepParse, LazyStepParse, StepCache, LoadCancelled, is_compressed, sparse
 
 
 
@@ -146,6 +153,23 @@ class MainWindow(wx.Frame):
         ### CREATE OBJECT FOR ASSEMBLY MANAGEMENT
         self.a = []
 
+        # Files larger than this (in bytes) are loaded lazily,
+        # i.e. parts list is populated as items are expanded
+        self.lazy_file_size = 100 << 20
+
+        # Trees with more nodes than this are created only partly, e.g. where sub-assemblies
+        # are used many times; remaining items are added as they are expanded
+        self.max_tree_size = 5000
+
+        # Lattice layout, set from "Lattice" menu; layered layouts need SciPy
+        self.lattice_layout = 'mean'
+
+        # On-disk cache of parsed STEP files, so reopening a file skips parsing
+        try:
+            self.step_cache = StepCache()
+        except OSError:
+            self.step_cache = None
+
         
         
         wx.Frame.__init__(self, parent = None, title = "StrEmbed-5-2")
@@ -162,6 +186,7 @@ class MainWindow(wx.Frame):
         fileSave = fileMenu.Append(wx.ID_SAVE, "&Save", "Save file")
         fileSaveAs = fileMenu.Append(wx.ID_SAVEAS, "&Save as", "Save file as")
         fileClose = fileMenu.Append(wx.ID_CLOSE, "&Close", "Close file")
+        fileWatch = fileMenu.AppendCheckItem(wx.ID_ANY, "&Watch file", "Reload file automatically when changed on disk")
         fileExit = fileMenu.Append(wx.ID_EXIT, "&Exit", "Exit program")
 
         partMenu = wx.Menu()
@@ -172,6 +197,14 @@ class MainWindow(wx.Frame):
 
         lattMenu = wx.Menu()
         menuBar.Append(lattMenu, "&Lattice")
+        self.layout_items = {}
+        for layout, text, help_text in (('mean',       "&Simple layout",     "Place assemblies at mean of parts"),
+                                        ('barycentre', "&Barycentre layout", "Reorder parts to reduce crossings, by barycentre"),
+                                        ('median',     "&Median layout",     "Reorder parts to reduce crossings, by median")):
+            menu_item = lattMenu.AppendRadioItem(wx.ID_ANY, text, help_text)
+            menu_item.Enable(layout == 'mean' or sparse is not None)
+            self.layout_items[menu_item.GetId()] = layout
+            self.Bind(wx.EVT_MENU, self.OnLatticeLayout, menu_item)
 
         abtMenu   = wx.Menu()
         menuBar.Append(abtMenu,  "&About")
@@ -186,6 +219,7 @@ class MainWindow(wx.Frame):
         self.Bind(wx.EVT_MENU, self.DoNothingDialog, fileSave)
         self.Bind(wx.EVT_MENU, self.DoNothingDialog, fileSaveAs)
         self.Bind(wx.EVT_MENU, self.OnExit,  fileClose)
+        self.Bind(wx.EVT_MENU, self.OnFileWatch, fileWatch)
         self.Bind(wx.EVT_MENU, self.OnExit,  fileExit)
         self.Bind(wx.EVT_MENU, self.OnAbout, menuAbout)
 
@@ -251,6 +285,23 @@ class MainWindow(wx.Frame):
 
 
 
+        ### FILE WATCHING
+        # Timer to poll open file for changes, if enabled via menu (interval in ms)
+        self.watch_interval = 1000
+        self.watch_timer    = wx.Timer(self)
+        self.Bind(wx.EVT_TIMER, self.OnWatchTimer, self.watch_timer)
+
+
+
+        ### FILE LOADING
+        # STEP files are loaded in worker thread while progress dialog is shown;
+        # "load_cancel" is set when user cancels, and checked by parser via progress callback
+        self.load_thread = None
+        self.load_cancel = threading.Event()
+        self.load_dialog = None
+
+
+
         # Create main panel
         self.InitMainPanel()
 
@@ -301,6 +352,7 @@ class MainWindow(wx.Frame):
         self.partTree_ctc.Bind(wx.EVT_TREE_BEGIN_DRAG,     self.OnTreeDrag)
         self.partTree_ctc.Bind(wx.EVT_TREE_END_DRAG,       self.OnTreeDrop)
         self.partTree_ctc.Bind(wx.EVT_TREE_END_LABEL_EDIT, self.OnTreeLabelEditEnd)
+        self.partTree_ctc.Bind(wx.EVT_TREE_ITEM_EXPANDING, self.OnTreeItemExpanding)
 
 
 
@@ -339,6 +391,36 @@ class MainWindow(wx.Frame):
 
         self.latt_canvas.mpl_connect('button_press_event',   self.GetLattPos)
         self.latt_canvas.mpl_connect('button_release_event', self.LattNodeSelected)
+        self.latt_canvas.mpl_connect('draw_event',           self.OnLattDraw)
+
+        # Lattice artists, created once per layout in "DisplayLattice" and recoloured on selection;
+        # background saved after each full draw for blitting, see "UpdateLatticeColours"
+        self.latt_nodes      = None
+        self.latt_labels     = {}
+        self.latt_node_ids   = []
+        self.latt_node_index = {}
+        self.latt_colours    = np.zeros((0, 4))
+        self.latt_selected   = set()
+        self.latt_background = None
+        self.latt_background_colours = self.latt_colours
+
+        # Lattices with more nodes than this are drawn with level of detail depending on zoom,
+        # sub-assemblies narrower than "lod_pixels" on screen being collapsed to single node,
+        # with at most "lod_max_nodes" nodes and labels only if no more than "lod_max_labels"
+        self.lod_size       = 2000
+        self.lod_pixels     = 20
+        self.lod_max_nodes  = 5000
+        self.lod_max_labels = 50
+        self.latt_lod       = False
+
+        # Lattice redraws requested by selections and edits are coalesced and done at most once
+        # per "render_interval" (in ms), see "ScheduleRender"; full layouts are computed in
+        # worker thread, results of layouts superseded by later requests being discarded
+        self.render_interval   = 16
+        self.render_pending    = set()
+        self.render_call       = None
+        self.layout_thread     = None
+        self.layout_generation = 0
         
         self.new_assembly_text = 'Unnamed item'
         self.new_part_text     = 'Unnamed item'
@@ -393,6 +475,10 @@ class MainWindow(wx.Frame):
             file_open_text = starter.upper() + " files (" + starter.lower() + "*)|" + starter.lower() + "*"
         elif starter is None and ender is not None:
             file_open_text = [el.upper() + " files (*." + el.lower() + ")|*." + el.lower() for el in ender]
+            # If more than one type, first show all together
+            if len(ender) > 1:
+                all_types = ";".join(["*." + el.lower() for el in ender])
+                file_open_text.insert(0, "All supported files (" + all_types + ")|" + all_types)
             file_open_text = "|".join(file_open_text)
         else:
             raise ValueError("Requires starter or ender only")
@@ -462,11 +548,42 @@ class MainWindow(wx.Frame):
         
         self.partTree_ctc.ExpandAll()
 
+        # Show expansion buttons for items not yet loaded
+        for el in self.assembly.unexpanded:
+            self.partTree_ctc.SetItemHasChildren(self.ctc_dict[el], True)
+
         # Sort all tree items
         self.partTree_ctc.SortAllChildren(self.partTree_ctc.GetRootItem())
         
         
         
+    def OnTreeItemExpanding(self, event):
+
+        # Add children of items not yet loaded
+        item = event.GetItem()
+        id_  = self.ctc_dict_inv.get(item)
+        if id_ not in self.assembly.unexpanded:
+            event.Skip()
+            return
+
+        for el in self.assembly.expand_node(id_):
+            parent_id  = self.assembly.tree.parent(el).identifier
+            ctc_parent = self.ctc_dict[parent_id]
+            ctc_text   = self.assembly.tree.nodes[el].tag
+            ctc_item   = self.partTree_ctc.AppendItem(ctc_parent, text = ctc_text, ct_type = 1, data = {'id_': el, 'sort_id': el})
+            self.ctc_dict[el]           = ctc_item
+            self.ctc_dict_inv[ctc_item] = el
+            if el in self.assembly.unexpanded:
+                self.partTree_ctc.SetItemHasChildren(ctc_item, True)
+        self.partTree_ctc.SortChildren(item)
+
+        # Update levels and lattice for new nodes
+        self.assembly.update_edits()
+        self.ScheduleRender('lattice', 'layout')
+        event.Skip()
+
+
+
     def ScaleImage(self, img, p_w = None, scaling = 0.90):
         
         # Get size of panel holding image if not given as argument
@@ -562,8 +679,8 @@ class MainWindow(wx.Frame):
         # selection means not all selections are tracked easily
         self.selected_items = self.partTree_ctc.GetSelections()
         
-        self.UpdateToggledImages()
-        self.UpdateLatticeSelections()
+        # Images and lattice updated once for all selections in same frame
+        self.ScheduleRender('selection')
 
 
 
@@ -572,7 +689,7 @@ class MainWindow(wx.Frame):
         id_ = self.button_dict_inv[event.GetEventObject()]
         self.UpdateListSelections(id_)
         
-        self.UpdateLatticeSelections()
+        self.ScheduleRender('selection')
 
 
 
@@ -582,69 +699,47 @@ class MainWindow(wx.Frame):
               ('Double click' if event.dblclick else 'Single click', event.button,
                event.x, event.y, event.xdata, event.ydata))
 
-        # Get position of click event
-        self.click_pos = (event.x, event.y)
+        # Get position of click event, on screen and in plot
+        self.click_pos  = (event.x, event.y)
+        self.click_data = (event.xdata, event.ydata)
         
         
         
     def LattNodeSelected(self, event):
-        
-        # Functor to find nearest value in sorted list
-        # ---
-        # HR 4/3/20 THIS SHOULD BE REWRITTEN COMPLETELY TO USE MPL PICKER/ARTIST FUNCTIONALITY
-        def get_nearest(value, list_in):
-                            
-            # First check if value beyond upper bound
-            if value > list_in[-1]:
-                print('case 1: beyond upper bound')
-                answer = list_in[-1]
-                
-            else:
-                for i,el in enumerate(list_in):
-                    if value < el:
-                        
-                        # Then check if below lower bound
-                        if i == 0:
-                            print('case 2: below lower bound')
-                            answer = list_in[0]
-                            break
-
-                        # All other cases: somewhere in between
-                        else:
-                            print('case 3: intermediate')
-                            if abs(value - el) < abs(value - list_in[i-1]):
-                                answer = el
-                            else:
-                                answer = list_in[i-1]
-                            break
-                    
-            return answer
-                       
+
+        # Select node nearest click, or nodes within rectangle dragged out (rubber-band selection),
+        # from spatial index of lattice positions built with layout
+        # Drags while zooming or panning with toolbar are left to toolbar
+        if event.xdata is None or event.ydata is None or self.click_data[0] is None:
+            return
+
         if event.x == self.click_pos[0] and event.y == self.click_pos[1]:
-            
-            # Get nearest y value (same as lattice level)#
-            # Must prepend lattice level of single part to list
-            y_list = self.assembly.levels_a_sorted[:]
-            y_list.insert(0, self.assembly.part_level)
-            y_  = get_nearest(event.ydata, y_list)
-            
-            # Get nearest x value within known y level
-            x_dict = {self.assembly.g.nodes[el]['pos'][0]:el for el in self.assembly.levels_a_inv[y_]}
-            x_list = [k for k,v in x_dict.items()]
-            x_  = get_nearest(event.xdata, sorted(x_list))
-            
-            # Get nearest node
-            id_ = x_dict[x_]
-            
+
+            # Scale distances to pixels, so nearest node is that nearest on screen
+            origin, unit = self.latt_axes.transData.transform([(0, 0), (1, 1)])
+            scale = abs(unit - origin)
+            id_, distance = self.assembly.lattice_index.get_nearest(event.xdata, event.ydata, scale)
+            if id_ is None:
+                return
+            id_ = self.GetShownNode(id_)
+
             print('Nearest node: x = %f, y = %f; node ID: %i\n' %
-                  (x_, y_, id_))
-            
+                  (*self.assembly.g.nodes[id_]['pos'], id_))
+
             self.latt_plotlims = (self.latt_axes.get_xlim(), self.latt_axes.get_ylim())
             print(self.latt_plotlims)
-            
+
             self.UpdateListSelections(id_)
 
-        
+        elif not self.latt_tb.mode:
+
+            ids = self.assembly.lattice_index.get_in_rect(*self.click_data, event.xdata, event.ydata)
+            print('Nodes in rectangle: %i' % len(ids))
+
+            self.latt_plotlims = (self.latt_axes.get_xlim(), self.latt_axes.get_ylim())
+            self.SelectItems([el for el in ids.tolist() if el in self.ctc_dict])
+
+
 
     def UpdateListSelections(self, id_):
         
@@ -663,20 +758,19 @@ class MainWindow(wx.Frame):
     def UpdateLatticeSelections(self):
         
         # Update colour of selected items
-        #
-        # Set all back to default colour first
-        for node in self.assembly.g.nodes():
-            self.assembly.g.nodes[node]['colour'] = self.assembly.default_colour
-        # Then selected nodes
-        for item in self.selected_items:
-            id_ = self.ctc_dict_inv[item]
-            self.assembly.g.nodes[id_]['colour'] = self.selected_colour
-        
+        # Only nodes selected now or before are updated, then lattice recoloured
+        selected = {self.ctc_dict_inv[item] for item in self.selected_items}
+        changed  = [el for el in selected ^ self.latt_selected if el in self.assembly.g]
+        for node in changed:
+            colour = self.selected_colour if node in selected else self.assembly.default_colour
+            self.assembly.g.nodes[node]['colour'] = colour
+        self.latt_selected = selected
+
         # Redraw lattice
-        self.DisplayLattice()
+        self.UpdateLatticeColours(changed)
+
 
 
-    
     def UpdateToggledImages(self):
         
         for id_, button in self.button_dict.items():
@@ -694,9 +788,20 @@ class MainWindow(wx.Frame):
 
     def DisplayLattice(self):
 
+        # Draw lattice, creating node, edge and label artists for current layout;
+        # selection changes then only recolour nodes, see "UpdateLatticeColours"
+        # Large lattices are drawn with level of detail, see "DisplayLatticeDetail"
+        self.latt_lod = len(self.assembly.g) > self.lod_size
+        if self.latt_lod:
+            self.DisplayLatticeDetail()
+            return
+
         # Get node positions, colour map, labels
         pos         = nx.get_node_attributes(self.assembly.g, 'pos')
-        colour_map  = [self.assembly.g.nodes[el]['colour'] for el in self.assembly.g.nodes]
+        self.latt_node_ids   = list(self.assembly.g.nodes)
+        self.latt_node_index = {el: i for i, el in enumerate(self.latt_node_ids)}
+        self.latt_colours    = mpl.colors.to_rgba_array([self.assembly.g.nodes[el]['colour'] for el in self.latt_node_ids])
+        self.latt_selected   = {el for el in self.latt_node_ids if self.assembly.g.nodes[el]['colour'] == self.selected_colour}
 #        node_labels = nx.get_node_attributes(self.assembly.g, 'label')
         
         try:
@@ -705,7 +810,12 @@ class MainWindow(wx.Frame):
             pass
         
         # Draw to lattice panel figure
-        nx.draw(self.assembly.g, pos, node_color = colour_map, with_labels = True, ax = self.latt_axes)
+        # Edges as single line collection, without arrows, as each arrow is separate artist
+        self.latt_nodes  = nx.draw_networkx_nodes(self.assembly.g, pos, nodelist = self.latt_node_ids,
+                                                  node_color = self.latt_colours, ax = self.latt_axes)
+        nx.draw_networkx_edges(self.assembly.g, pos, arrows = False, ax = self.latt_axes)
+        self.latt_labels = nx.draw_networkx_labels(self.assembly.g, pos, ax = self.latt_axes)
+        self.latt_axes.set_axis_off()
 #        nx.draw_networkx_labels(self.assembly.g, pos, labels = node_labels, ax = self.latt_axes)
 
         # Minimise white space around plot in panel
@@ -727,30 +837,365 @@ class MainWindow(wx.Frame):
 
 
 
+    def DisplayLatticeDetail(self):
+
+        # Draw lattice with level of detail: nodes and collapsed sub-assemblies as two collections
+        # and edges as single line collection, filled from current view by "UpdateLatticeDetail"
+        # and refilled whenever view changes, e.g. by zooming or panning with toolbar
+        self.latt_selected = {el for el, colour in self.assembly.g.nodes(data = 'colour') if colour == self.selected_colour}
+        self.latt_n_parts  = max(1, len(self.assembly.tree.get_leaf_ids()))
+        self.latt_labels   = {}
+        self.latt_nodes    = None
+
+        try:
+            self.latt_axes.clear()
+        except:
+            pass
+
+        self.latt_edges  = LineCollection([], colors = 'k', linewidths = 1, zorder = 1)
+        self.latt_axes.add_collection(self.latt_edges)
+        self.latt_parts  = self.latt_axes.scatter([], [], s = 100, marker = 'o', zorder = 2)
+        self.latt_groups = self.latt_axes.scatter([], [], s = 100, marker = 's', zorder = 2)
+        self.latt_axes.set_axis_off()
+
+        # Minimise white space around plot in panel
+        self.latt_figure.subplots_adjust(left = 0.01, bottom = 0.01, right = 0.99, top = 0.99)
+
+        # Whole lattice, unless zoomed in already
+        try:
+            self.latt_axes.set_xlim(self.latt_plotlims[0])
+            self.latt_axes.set_ylim(self.latt_plotlims[1])
+        except:
+            index = self.assembly.lattice_index
+            self.latt_axes.set_xlim(index.x.min() - 0.05, index.x.max() + 0.05)
+            self.latt_axes.set_ylim(index.y.min() - 1, index.y.max() + 1)
+
+        self.UpdateLatticeDetail()
+        self.latt_axes.callbacks.connect('xlim_changed', self.UpdateLatticeDetail)
+        self.latt_axes.callbacks.connect('ylim_changed', self.UpdateLatticeDetail)
+
+        # Show lattice figure
+        self.latt_canvas.draw()
+        self.latt_canvas.Show()
+        self.latt_tb.Show()
+
+        # Update lattice panel layout
+        self.latt_panel.Layout()
+
+
+
+    def UpdateLatticeDetail(self, axes = None):
+
+        # Fill level-of-detail artists for current view, without drawing; collapsed sub-assemblies
+        # are square, sized by number of parts, and labelled with it if labels shown
+        (x_0, x_1), (y_0, y_1) = self.latt_axes.get_xlim(), self.latt_axes.get_ylim()
+        pixels_per_part = self.latt_axes.bbox.width/(self.latt_n_parts*max(abs(x_1 - x_0), 1e-12))
+        ids, x, y, collapsed, segments, self.latt_max_parts = self.assembly.get_lattice_detail(
+            self.lod_pixels/pixels_per_part, (x_0, y_0, x_1, y_1), self.lod_max_nodes)
+
+        colours = np.where(np.isin(ids, list(self.latt_selected)), self.selected_colour, self.assembly.default_colour)
+        n_p     = self.assembly.n_p[ids[collapsed]]
+        self.latt_parts.set_offsets(np.column_stack((x[~collapsed], y[~collapsed])))
+        self.latt_parts.set_facecolor(colours[~collapsed])
+        self.latt_groups.set_offsets(np.column_stack((x[collapsed], y[collapsed])))
+        self.latt_groups.set_facecolor(colours[collapsed])
+        self.latt_groups.set_sizes(100*(1 + np.log10(np.maximum(n_p, 1))))
+        self.latt_edges.set_segments(segments)
+
+        for text in self.latt_labels.values():
+            text.remove()
+        self.latt_labels = {}
+        if len(ids) <= self.lod_max_labels:
+            for id_, x_, y_, is_group in zip(ids.tolist(), x.tolist(), y.tolist(), collapsed.tolist()):
+                text = '%i (%i)' % (id_, self.assembly.n_p[id_]) if is_group else str(id_)
+                self.latt_labels[id_] = self.latt_axes.text(x_, y_, text, ha = 'center', va = 'center', zorder = 3)
+
+
+
+    def GetShownNode(self, id_):
+
+        # Get node shown for given node in level-of-detail view, i.e. node itself
+        # or collapsed sub-assembly containing it
+        if not self.latt_lod:
+            return id_
+        shown = id_
+        parent = self.assembly.tree.parent(id_)
+        while parent:
+            if self.assembly.n_p[parent.identifier] <= self.latt_max_parts:
+                shown = parent.identifier
+            parent = self.assembly.tree.parent(parent.identifier)
+        return shown
+
+
+
+    def OnLattDraw(self, event):
+
+        # Save background after full draw (including zoom/pan), with node colours as drawn
+        self.latt_background = self.latt_canvas.copy_from_bbox(self.latt_axes.bbox)
+        self.latt_background_colours = self.latt_colours.copy()
+
+
+
+    def UpdateLatticeColours(self, ids = None):
+
+        # Recolour lattice nodes with given IDs (all if None) from graph, without recreating artists
+        # ---
+        # Node collection takes new colours for later full draws; on screen, saved background
+        # is restored and only nodes whose colour differs from it are drawn over it, with labels,
+        # then blitted; level-of-detail view is refilled and drawn instead
+        if self.latt_lod:
+            self.UpdateLatticeDetail()
+            self.latt_canvas.draw_idle()
+            return
+        if self.latt_nodes is None or len(self.latt_node_ids) != len(self.assembly.g):
+            self.DisplayLattice()
+            return
+        if ids is None:
+            ids = self.latt_node_ids
+        if any(el not in self.latt_node_index for el in ids):
+            self.DisplayLattice()
+            return
+
+        for el in ids:
+            self.latt_colours[self.latt_node_index[el]] = mpl.colors.to_rgba(self.assembly.g.nodes[el]['colour'])
+        self.latt_nodes.set_facecolor(self.latt_colours)
+
+        if self.latt_background is None or not self.latt_canvas.supports_blit:
+            self.latt_canvas.draw_idle()
+            return
+
+        changed = np.flatnonzero((self.latt_colours != self.latt_background_colours).any(axis = 1))
+        self.latt_canvas.restore_region(self.latt_background)
+        if len(changed):
+            # Node collection drawn with changed nodes only, then restored
+            offsets = self.latt_nodes.get_offsets()
+            self.latt_nodes.set_offsets(offsets[changed])
+            self.latt_nodes.set_facecolor(self.latt_colours[changed])
+            self.latt_axes.draw_artist(self.latt_nodes)
+            self.latt_nodes.set_offsets(offsets)
+            self.latt_nodes.set_facecolor(self.latt_colours)
+            for i in changed.tolist():
+                self.latt_axes.draw_artist(self.latt_labels[self.latt_node_ids[i]])
+        self.latt_canvas.blit(self.latt_axes.bbox)
+
+
+
+    def ScheduleRender(self, *what):
+
+        # Request lattice update, done with any others made before next frame, see "OnRender":
+        # "selection" to update toggled images and lattice colours from selected items,
+        # "lattice" to draw lattice again and "layout" to lay out lattice again in worker thread
+        # Layout requests supersede any layout in progress, so must be made after all tree edits
+        if 'layout' in what:
+            self.layout_generation += 1
+        self.render_pending.update(what)
+        if self.render_call is None:
+            self.render_call = wx.CallLater(self.render_interval, self.OnRender)
+
+
+
+    def OnRender(self):
+
+        # Do lattice updates requested since last frame, each once
+        pending = self.render_pending
+        self.render_pending = set()
+        self.render_call    = None
+        if not self.file_open:
+            return
+        if 'layout' in pending:
+            self.StartLayout()
+        if 'lattice' in pending:
+            self.DisplayLattice()
+        if 'selection' in pending:
+            self.UpdateToggledImages()
+            self.UpdateLatticeSelections()
+
+
+
+    def StartLayout(self):
+
+        # Lay out lattice in worker thread, on snapshot of assembly so it can be edited meanwhile;
+        # only one layout is done at a time, any later request being started when it finishes
+        if self.layout_thread is not None:
+            return
+        assembly   = self.assembly
+        snapshot   = assembly.get_layout_snapshot()
+        generation = self.layout_generation
+
+        def layout():
+            try:
+                positions = snapshot.get_layout()
+            except Exception as e:
+                print('Lattice layout failed: %s' % e)
+                positions = None
+            wx.CallAfter(self.AfterLayout, assembly, generation, positions)
+
+        self.layout_thread = threading.Thread(target = layout, daemon = True)
+        self.layout_thread.start()
+
+
+
+    def AfterLayout(self, assembly, generation, positions):
+
+        # Apply layout from worker thread and redraw, unless superseded by later request
+        # (i.e. tree edited or layout changed since), in which case layout is done again,
+        # or made for assembly no longer shown
+        self.layout_thread.join()
+        self.layout_thread = None
+        if assembly is not self.assembly or not self.file_open:
+            return
+        if generation != self.layout_generation:
+            self.StartLayout()
+            return
+        if positions is not None:
+            assembly.set_lattice_positions(positions)
+            self.ScheduleRender('lattice')
+
+
+
     def OnFileOpen(self, event):
         
+        # Only one file loaded at a time
+        if self.load_thread is not None:
+            return
+
         # Get STEP filename
-        self.open_filename = self.GetFilename(ender = ["stp", "step"]).split("\\")[-1]
+        # Compressed files (gzip, zip, STEP-Z) are read directly
+        filename = self.GetFilename(ender = ["stp", "step", "stpz", "stp.gz", "step.gz", "zip"]).split("\\")[-1]
         
         # Return if filename is empty, i.e. if user selects "cancel" in file-open dialog
-        if not self.open_filename:
+        if not filename:
+            return
+
+        # Create assembly; not added to assembly manager until loaded
+        # Large files loaded lazily, unless compressed as no random access
+        compressed = is_compressed(filename)
+        if os.path.getsize(filename) > self.lazy_file_size and not compressed:
+            assembly = LazyStepParse()
+        else:
+            assembly = StepParse()
+        assembly.max_tree_size = self.max_tree_size
+        assembly.layout        = self.lattice_layout
+        self.StartLoad(assembly, filename)
+
+
+
+    def StartLoad(self, assembly, filename, reload = None):
+
+        # Load data, create nodes and edges, etc. in worker thread, with progress dialog;
+        # "reload" is None for file opened, else as for "LoadFile"
+        # Progress given as fraction of file read, so unknown for compressed files
+        # as parser reports offsets in decompressed data
+        self.load_size   = None if is_compressed(filename) else os.path.getsize(filename)
+        self.load_cancel.clear()
+        self.load_dialog = wx.ProgressDialog('Reloading file' if reload else 'Opening file',
+                                             'Reading ' + os.path.basename(filename),
+                                             maximum = 1000, parent = self,
+                                             style = wx.PD_APP_MODAL | wx.PD_CAN_ABORT | wx.PD_ELAPSED_TIME)
+        self.load_thread = threading.Thread(target = self.LoadFile, args = (assembly, filename, reload), daemon = True)
+        self.load_thread.start()
+
+
+
+    def LoadFile(self, assembly, filename, reload = None):
+
+        # Load STEP file (in worker thread); results handed back to main thread via "AfterFileOpen"
+        # GUI must not be touched here other than via "wx.CallAfter"
+        # If "reload" is "patch", file is only parsed, to be patched into open assembly,
+        # else ("full") it replaces open assembly, see "OnFileChanged"
+        def progress(pos, count):
+            if self.load_cancel.is_set():
+                return False
+            wx.CallAfter(self.OnLoadProgress, filename, pos, count)
+
+        error = None
+        try:
+            if reload == 'patch':
+                assembly.load_step(filename, progress = progress)
+            else:
+                assembly.load(filename, cache = self.step_cache, cancel = self.load_cancel, progress = progress)
+        except LoadCancelled:
+            assembly.close()
+            assembly = None
+        except Exception as e:
+            assembly.close()
+            assembly = None
+            error    = e
+        wx.CallAfter(self.AfterFileOpen, assembly, filename, error, reload)
+
+
+
+    def OnLoadProgress(self, filename, pos, count):
+
+        # Update progress dialog with file position and no. of product-structure entities found
+        # Cancelling is picked up by parser at next progress report
+        if self.load_dialog is None or self.load_cancel.is_set():
             return
+        message = '%s\n%.1f MB read, %i entities found' % (os.path.basename(filename), pos/(1 << 20), count)
+        if self.load_size:
+            if pos >= self.load_size:
+                message += '\nCreating tree...'
+            cont, skip = self.load_dialog.Update(min(1000, int(1000*pos/self.load_size)), message)
+        else:
+            cont, skip = self.load_dialog.Pulse(message)
+        if not cont:
+            self.load_cancel.set()
+            self.load_dialog.Update(self.load_dialog.GetValue(), 'Cancelling...')
+
+
+
+    def AfterFileOpen(self, assembly, filename, error = None, reload = None):
+
+        # Finish opening file (in main thread) once worker thread is done
+        # If cancelled or failed, any previously open file is left as it was;
+        # cancelling may be too late for worker, e.g. if tree was being created, so is checked here too
+        self.load_thread.join()
+        self.load_thread = None
+        if self.load_dialog.WasCancelled():
+            self.load_cancel.set()
+        self.load_dialog.Destroy()
+        self.load_dialog = None
+
+        if error is not None:
+            print('Could not open file: %s' % error)
+            msg = wx.MessageDialog(self, 'Could not open file:\n%s' % error, 'Error opening file', wx.OK | wx.ICON_ERROR)
+            msg.ShowModal()
+            msg.Destroy()
+            return
+        if assembly is None or self.load_cancel.is_set():
+            if assembly is not None:
+                assembly.close()
+            print('File opening cancelled')
+            return
+
+        # Open assembly patched where file has changed, see "OnFileChanged"
+        if reload == 'patch':
+            diff = self.assembly.reload_step(loaded = assembly)
+            print('File reloaded: %i entities added, %i removed, %i changed' %
+                  (len(diff['added']), len(diff['removed']), len(diff['changed'])))
+            self.ClearGUIItems()
+            self.ClearLatticeSelections()
+            self.DisplayPartsList()
+            self.ScheduleRender('lattice', 'layout')
+            return
+
+        # Reloaded assembly takes place of open one in assembly manager
+        if reload == 'full' and self.assembly in self.a:
+            self.a.remove(self.assembly)
+            self.assembly.close()
+
+        self.open_filename = filename
 
         # "File is open" tag
         self.file_open = True
+        self.file_stamp = self.GetFileStamp()
         
         # Tracker for assembly modifications
         self.changes_made_to_assembly = False
 
         # Append to assembly manager
-        self.a.append(StepParse())
-
-
-
-        # Load data, create nodes and edges, etc.
+        self.a.append(assembly)
         self.assembly = self.a[-1]
-        self.assembly.load_step(self.open_filename)
-        self.assembly.create_tree()
         
         # Write interactive parts list using WX customtreectrl, from treelib nodes
         self.ctc_dict     = {}
@@ -787,6 +1232,71 @@ class MainWindow(wx.Frame):
 
 
 
+    def GetFileStamp(self):
+
+        # Size and modification time of open file, to detect changes
+        stat = os.stat(self.open_filename)
+        return (stat.st_size, stat.st_mtime)
+
+
+
+    def OnLatticeLayout(self, event):
+
+        # Lay out lattice again with layout chosen in "Lattice" menu
+        self.lattice_layout = self.layout_items[event.GetId()]
+        if not self.file_open:
+            return
+        self.assembly.layout = self.lattice_layout
+        self.ScheduleRender('layout')
+
+
+
+    def OnFileWatch(self, event):
+
+        # Start/stop polling open file for changes
+        if event.IsChecked():
+            self.watch_timer.Start(self.watch_interval)
+        else:
+            self.watch_timer.Stop()
+
+
+
+    def OnWatchTimer(self, event):
+
+        if not self.file_open or self.load_thread is not None:
+            return
+        # File may be missing briefly while being rewritten
+        try:
+            stamp = self.GetFileStamp()
+        except OSError:
+            return
+        if stamp != self.file_stamp:
+            self.file_stamp = stamp
+            self.OnFileChanged()
+
+
+
+    def OnFileChanged(self):
+
+        # Reload open file after change on disk, in worker thread as when opened (see "StartLoad")
+        # Tree, levels and lattice are patched where changed, unless assembly
+        # has been modified by user (or is lazily loaded), in which case full reload needed
+        if self.changes_made_to_assembly:
+            caption = 'Reload file?'
+            message = 'File has changed on disk. Do you want to reload it? Changes to assembly will be lost'
+            if not self.okay_to_proceed(message, caption):
+                print('Not reloading!')
+                return
+        if self.changes_made_to_assembly or isinstance(self.assembly, LazyStepParse):
+            assembly = type(self.assembly)()
+            assembly.max_tree_size = self.max_tree_size
+            assembly.layout        = self.lattice_layout
+            self.StartLoad(assembly, self.open_filename, 'full')
+        else:
+            self.StartLoad(StepParse(), self.open_filename, 'patch')
+
+
+
     def OnPartsRC(self, event = None):
         
         # HR 5/3/20 SOME DUPLICATION HERE WITH OPERATION-SPECIFIC METHOD, E.G. "ONFLATTEN"
@@ -830,6 +1340,9 @@ class MainWindow(wx.Frame):
                 menu_text = 'Sort children by unique ID'
                 menu_item = menu.Append(wx.ID_ANY, menu_text, menu_text)
                 self.Bind(wx.EVT_MENU, self.OnSortByID, menu_item)
+                # Selection options
+                menu_item = menu.Append(wx.ID_ANY, 'Select branch', 'Select assembly and all items within it')
+                self.Bind(wx.EVT_MENU, self.OnSelectBranch, menu_item)
 
         # Multiple-item options
         elif len(self.selected_items) > 1:
@@ -837,12 +1350,53 @@ class MainWindow(wx.Frame):
             self.Bind(wx.EVT_MENU, self.OnAssemble, menu_item)
             menu_item = menu.Append(wx.ID_ANY, 'Remove parts', 'Remove parts')
             self.Bind(wx.EVT_MENU, self.OnRemoveNode, menu_item)
+            # Selection options
+            menu_item = menu.Append(wx.ID_ANY, 'Select common assembly', 'Select lowest assembly containing all selected items')
+            self.Bind(wx.EVT_MENU, self.OnSelectCommon, menu_item)
+            menu_item = menu.Append(wx.ID_ANY, 'Select branch', 'Select all items within lowest assembly containing selected items')
+            self.Bind(wx.EVT_MENU, self.OnSelectBranch, menu_item)
             
         self.PopupMenu(menu, pos)
         menu.Destroy()
 
 
 
+    def OnSelectCommon(self, event = None):
+
+        # Replace selection with lowest common ancestor of selected items
+        if not self.selected_items_check():
+            print('No items selected')
+            return
+        ids = [self.ctc_dict_inv[el] for el in self.selected_items]
+        self.SelectItems([self.assembly.tree.get_common_ancestor(ids)])
+
+
+
+    def OnSelectBranch(self, event = None):
+
+        # Replace selection with lowest common ancestor of selected items and all its descendants
+        if not self.selected_items_check():
+            print('No items selected')
+            return
+        ids = [self.ctc_dict_inv[el] for el in self.selected_items]
+        id_ = self.assembly.tree.get_common_ancestor(ids)
+        self.SelectItems([id_] + self.assembly.get_all_children(id_))
+
+
+
+    def SelectItems(self, ids):
+
+        # Select parts list items with given IDs only, then update other views
+        self.partTree_ctc.UnselectAll()
+        for id_ in ids:
+            # With "select = True", SelectItem toggles state if multiple selections enabled
+            self.partTree_ctc.SelectItem(self.ctc_dict[id_], select = True)
+        self.selected_items = self.partTree_ctc.GetSelections()
+
+        self.ScheduleRender('selection')
+
+
+
     def OnAssemble(self, event = None):
         
         # Check selected items are present and suitable
@@ -866,6 +1420,12 @@ class MainWindow(wx.Frame):
         if self.assembly.tree.root in self.selected_list:
             print('Cannot create assembly: items to assemble include root')
             return
+
+        # Check no selected item is within another
+        for id_ in self.selected_list:
+            if any(self.assembly.tree.is_ancestor(el, id_) for el in self.selected_list):
+                print('Cannot create assembly: items to assemble include item and its sub-assembly')
+                return
          
         # Check with user whether to proceed, as link to STEP file will be lost
         if not self.changes_made_to_assembly:
@@ -881,13 +1441,10 @@ class MainWindow(wx.Frame):
                 
         # MAIN "ASSEMBLE" ALGORITHM
         # ---
-        # Get selected item that is highest up tree (i.e. lowest depth)
-        depths = {}
-        for id_ in self.selected_list:
-            depths[id_] = self.assembly.tree.depth(id_)
-            print('ID = ', id_, '; parent depth = ', depths[id_])
-        highest_node = min(depths, key = depths.get)
-        parent_      = self.assembly.tree.parent(highest_node).identifier
+        # Get lowest common ancestor of selected items, which is parent of new assembly
+        # (i.e. parent of all if they are siblings)
+        parent_ = self.assembly.tree.get_common_ancestor(self.selected_list)
+        print('ID of common ancestor = ', parent_)
         
         # Get valid ID for new node then create
         new_id   = self.create_new_id()
@@ -907,20 +1464,30 @@ class MainWindow(wx.Frame):
         
     def create_new_id(self):
         
-        # Get new item ID that is greater than largest existing ID in tree ctrl
-        id_ = max(self.assembly.tree_dict) + 1
-        return id_
+        # Get new item ID not used in tree, without searching whole tree each time
+        return self.assembly.get_new_id()
         
         
     
     def OnTreeCtrlChanged(self):
         
-        # Remake parts list and lattice
-        # HR 17/02/2020 MUST BE IMPROVED SO ONLY AFFECTED CTC AND LATTICE ITEMS MODIFIED
+        # Remake parts list; levels and lattice updated only for items affected by edits
+        # HR 17/02/2020 MUST BE IMPROVED SO ONLY AFFECTED CTC ITEMS MODIFIED
         self.DisplayPartsList()
-        self.assembly.get_levels()
-        self.assembly.create_lattice()
-        self.DisplayLattice()
+        self.assembly.update_edits()
+        self.ClearLatticeSelections()
+        self.ScheduleRender('lattice', 'layout')
+
+
+
+    def ClearLatticeSelections(self):
+
+        # Reset lattice nodes selected before to default colour, after selection cleared
+        # (see "ClearGUIItems"), as lattice is patched after edits rather than made again
+        for id_ in self.latt_selected:
+            if id_ in self.assembly.g:
+                self.assembly.g.nodes[id_]['colour'] = self.assembly.default_colour
+        self.latt_selected = set()
         
 
 
@@ -957,6 +1524,13 @@ class MainWindow(wx.Frame):
         
         # MAIN "FLATTEN" ALGORITHM
         # ---
+        # Unexpanded sub-assemblies (or item itself) expanded in full first, so that their parts are kept
+        unexpanded = [el for el in [id_] + self.assembly.get_all_children(id_) if el in self.assembly.unexpanded]
+        for el in unexpanded:
+            self.assembly.expand_node(el, None)
+        if unexpanded:
+            self.assembly.update_edits()
+
         # Get immediate children of item
         children_      = self.assembly.get_all_children(id_)
         children_parts = [el for el in children_ if el in self.assembly.leaf_ids]
@@ -1306,6 +1880,11 @@ class MainWindow(wx.Frame):
             print('Drag or drop item is root: cannot proceed')
             return
 
+        # Check item not dropped within its own sub-assembly; return if so
+        if self.tree_drag_id == id_ or self.assembly.tree.is_ancestor(self.tree_drag_id, id_):
+            print('Cannot move item into its own sub-assembly')
+            return
+
         # Check with user whether to proceed, as link to STEP file will be lost
         if not self.changes_made_to_assembly:
             caption = 'Move item(s)?'
@@ -1530,6 +2109,7 @@ class MainWindow(wx.Frame):
     def OnExit(self, event):
 
         # Close program
+        self.watch_timer.Stop()
         self.Close(True)
 
         
@@ -0,0 +1,387 @@
+# Benchmarks for STEP parsing and assembly operations in step_parse_5_2
+# Usage: python step_bench_5_2.py [STEP file(s)] [--workers N] [--synthetic MB] [--tree] [--lattice]
+# Defaults to torch example in this folder
+
+
+
+import argparse
+import os
+import random
+import time
+import tracemalloc
+
+from step_parse_5_2 import StepParse, AssemblyTree, iter_entities, STEP_TYPES, sparse
+
+
+
+def best_time(fn, repeats = 5):
+
+    # Best wall-clock time of "repeats" calls to "fn"
+    best = float('inf')
+    for i in range(repeats):
+        start = time.perf_counter()
+        fn()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+
+def make_synthetic_step(step_filename, n_parts, branching = 10, filler = 0, text = ''):
+
+    # Write STEP file with "n_parts" parts grouped into assemblies of "branching" children
+    # up to single root, plus "filler" geometry entities spread through DATA section
+    # "text" is added to names of parts and points, e.g. comments or ";" within strings
+    lines = ['ISO-10303-21;', 'HEADER;', "FILE_NAME ('%s');" % os.path.basename(step_filename), 'ENDSEC;', 'DATA;']
+    id_ = [0]
+
+    def add(text):
+        id_[0] += 1
+        lines.append('#%i = %s ;' % (id_[0], text % {'id': id_[0]}))
+        return id_[0]
+
+    def add_product(name):
+        prod      = add("PRODUCT ( '%s', '%s', '', ( #1 ) )" % (name, name))
+        prod_form = add("PRODUCT_DEFINITION_FORMATION_WITH_SPECIFIED_SOURCE ( 'ANY', '', #%i, .NOT_KNOWN. )" % prod)
+        return add("PRODUCT_DEFINITION ( 'UNKNOWN', '', #%i, #2 )" % prod_form)
+
+    add("PRODUCT_CONTEXT ( 'NONE', #3, 'mechanical' )")
+    add("PRODUCT_DEFINITION_CONTEXT ( 'detailed design', #3, 'design' )")
+    add("APPLICATION_CONTEXT ( 'automotive_design' )")
+
+    per_part = filler//max(n_parts, 1)
+    layer = []
+    for i in range(n_parts):
+        layer.append(add_product('PART %i%s' % (i, text)))
+        for j in range(per_part):
+            add("CARTESIAN_POINT ( 'NONE%s',  ( %i.000000, %i.000000, 0.000000 ) )" % (text, i, j))
+    k = 0
+    while len(layer) > 1:
+        next_layer = []
+        for i in range(0, len(layer), branching):
+            parent = add_product('ASSEMBLY %i' % k)
+            k += 1
+            for child in layer[i:i + branching]:
+                add("NEXT_ASSEMBLY_USAGE_OCCURRENCE ( 'NAUO%(id)i', ' ', '', #" + str(parent) + ", #" + str(child) + ", $ )")
+            next_layer.append(parent)
+        layer = next_layer
+
+    lines += ['ENDSEC;', 'END-ISO-10303-21;']
+    with open(step_filename, 'w') as f:
+        f.write('\n'.join(lines) + '\n')
+
+
+
+def make_synthetic_assembly(assembly, n_occurrences, branching = 10, depth = None, seed = None):
+
+    # Fill "assembly" with product structure of about "n_occurrences" NAUOs, without STEP file
+    # Balanced tree of "branching" children per assembly, or chain of "depth" assemblies
+    # each with remaining parts spread evenly along it, to test deep trees; use
+    # "branching" = "n_occurrences" for flat assembly, i.e. all parts children of root
+    # If "seed" given, random tree, each product child of random earlier one, whose lattice
+    # has many edge crossings unless laid out to avoid them
+    assembly.nauo_refs = []
+    assembly.part_dict = {}
+    n = [0]
+
+    def add_product():
+        n[0] += 1
+        ref = '#%i' % n[0]
+        assembly.part_dict[ref] = 'PRODUCT %i' % n[0]
+        return ref
+
+    def add_nauo(parent, child):
+        assembly.nauo_refs.append(['#n%i' % len(assembly.nauo_refs), parent, child])
+
+    root = add_product()
+    if seed is not None:
+        rng      = random.Random(seed)
+        products = [root]
+        for i in range(n_occurrences):
+            child = add_product()
+            add_nauo(rng.choice(products), child)
+            products.append(child)
+    elif depth:
+        per_level = max(1, (n_occurrences - depth)//depth)
+        parent = root
+        for i in range(depth):
+            for j in range(per_level):
+                add_nauo(parent, add_product())
+            child = add_product()
+            add_nauo(parent, child)
+            parent = child
+    else:
+        layer = [root]
+        while len(assembly.nauo_refs) < n_occurrences:
+            next_layer = []
+            for parent in layer:
+                for j in range(branching):
+                    child = add_product()
+                    add_nauo(parent, child)
+                    next_layer.append(child)
+            layer = next_layer
+    assembly.get_type_refs()
+
+
+
+class TreeOnly(StepParse):
+
+    # Skip levels and lattice, to time tree construction alone
+    def get_levels(self):
+        pass
+
+
+
+def bench_create_tree(sizes = (10000, 100000, 1000000), repeats = 3):
+
+    # Time of "create_tree" vs number of NAUOs, for balanced, deep (chain) and flat assemblies
+    # Time per occurrence should stay roughly constant, i.e. linear scaling
+    for shape in ('balanced', 'deep', 'flat'):
+        print('create_tree, %s assembly:' % shape)
+        for size in sizes:
+            assembly = TreeOnly()
+            make_synthetic_assembly(assembly, size, branching = size if shape == 'flat' else 10,
+                                    depth = size//10 if shape == 'deep' else None)
+            n = len(assembly.nauo_refs)
+            t = best_time(assembly.create_tree, repeats)
+            print('  %8i occurrences: %8.3f s, %6.2f us/occurrence' % (n, t, 1e6*t/n))
+
+
+
+class LevelsOnly(StepParse):
+
+    # Skip lattice, to time levels alone
+    def create_lattice(self):
+        pass
+
+
+
+def bench_get_levels(sizes = (10000, 100000), repeats = 3):
+
+    # Time of "get_levels" (without lattice) vs number of nodes, for balanced synthetic assembly
+    print('get_levels:')
+    for size in sizes:
+        assembly = TreeOnly()
+        make_synthetic_assembly(assembly, size)
+        assembly.create_tree()
+        assembly.__class__ = LevelsOnly
+        t = best_time(assembly.get_levels, repeats)
+        print('  %8i nodes: %8.3f s' % (assembly.tree.size(), t))
+
+
+
+def bench_tree_memory(sizes = (10000, 100000)):
+
+    # Memory of tree alone, compact "AssemblyTree" vs treelib, for balanced synthetic assembly;
+    # each is copied from tree created as usual, so only memory of copy is counted
+    def copy_tree(tree):
+        new_tree = AssemblyTree()
+        for el in tree.get_ids().tolist():
+            node   = tree.get_node(el)
+            parent = tree.parent(el)
+            new_tree.create_node(node.tag, el, parent = parent.identifier if parent else None, data = node.data)
+        return new_tree
+
+    for size in sizes:
+        assembly = TreeOnly()
+        make_synthetic_assembly(assembly, size)
+        assembly.create_tree()
+        print('  %8i nodes:' % assembly.tree.size(), end = '')
+        for name, fn in (('AssemblyTree', copy_tree), ('treelib', AssemblyTree.to_treelib)):
+            tracemalloc.start()
+            tree = fn(assembly.tree)
+            current, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            del tree
+            print(' %s %.1f MB' % (name, current/1e6), end = '')
+        print()
+
+
+
+class LoopLattice(StepParse):
+
+    # Lattice layout node by node, as before array-based "get_lattice_positions",
+    # for comparison of results and timing
+    def set_lattice_positions(self):
+
+        if self.tree.size() == 1:
+            id_ = [el.identifier for el in self.tree.leaves()]
+            self.g.nodes[id_[-1]]['pos'] = (0,0)
+            return
+
+        leaf_ids     = self.tree.get_leaf_ids().tolist()
+        child_ids    = set(leaf_ids)
+        leaf_parents = set([self.tree.parent(el).identifier for el in leaf_ids])
+
+        i = 0
+        no_leaves = len(child_ids)
+        for el in leaf_parents:
+            for el_ in self.tree.is_branch(el):
+                if el_ in child_ids:
+                    self.g.nodes[el_]['pos'] = ((i/(no_leaves)),self.levels[el_]['n_a'])
+                    i += 1
+
+        for el in sorted(list(self.levels_set_a)):
+            node_ids = [k for k,v in self.levels.items() if v['n_a'] == el]
+            for el_ in node_ids:
+                child_ids = self.tree.is_branch(el_)
+                if not child_ids:
+                    continue
+                pos_sum = 0
+                for el__ in child_ids:
+                    pos_    = self.g.nodes[el__]['pos'][0]
+                    pos_sum += pos_
+                pos_sum = pos_sum/len(child_ids)
+                self.g.nodes[el_]['pos'] = (pos_sum, el)
+
+
+
+def bench_lattice(sizes = (1000, 10000, 100000), deep_sizes = (1000, 10000), repeats = 3):
+
+    # Time of lattice layout, node by node ("LoopLattice") vs array-based ("StepParse"),
+    # for balanced and deep (chain) synthetic assemblies; also checks positions are the same
+    # Node-by-node layout is quadratic in depth, hence fewer sizes for deep assemblies
+    for shape, shape_sizes in (('balanced', sizes), ('deep', deep_sizes)):
+        print('set_lattice_positions, %s assembly:' % shape)
+        for size in shape_sizes:
+            times = []
+            pos   = []
+            for cls in (LoopLattice, StepParse):
+                assembly = cls()
+                make_synthetic_assembly(assembly, size, depth = size//10 if shape == 'deep' else None)
+                assembly.create_tree()
+                times.append(best_time(assembly.set_lattice_positions, repeats))
+                pos.append(dict(assembly.g.nodes(data = 'pos')))
+            same = pos[0].keys() == pos[1].keys() and all(
+                abs(pos[0][k][0] - pos[1][k][0]) < 1e-12 and pos[0][k][1] == pos[1][k][1] for k in pos[0])
+            print('  %8i nodes: loop %8.3f s, arrays %8.3f s, speedup = %6.1f, same positions: %s'
+                  % (len(pos[0]), times[0], times[1], times[0]/times[1], same))
+
+
+
+def bench_layouts(sizes = (10000, 100000), repeats = 3):
+
+    # Time of each lattice layout, see "StepParse.set_lattice_positions", and number of
+    # edge crossings in it, for balanced, deep (chain) and random synthetic assemblies;
+    # layered layouts only if SciPy available; crossings not counted ("-") if too many edge pieces,
+    # in which case layered layouts are as "mean", see "StepParse.get_edge_pieces"
+    layouts = ('mean', 'barycentre', 'median') if sparse is not None else ('mean',)
+    for shape in ('balanced', 'deep', 'random'):
+        print('Lattice layouts, %s assembly:' % shape)
+        for size in sizes:
+            assembly = StepParse()
+            make_synthetic_assembly(assembly, size, depth = size//10 if shape == 'deep' else None,
+                                    seed = 0 if shape == 'random' else None)
+            assembly.create_tree()
+            print('  %8i nodes:' % assembly.tree.size(), end = '')
+            for layout in layouts:
+                assembly.layout = layout
+                t = best_time(assembly.set_lattice_positions, repeats)
+                crossings = assembly.get_crossings()
+                print(' %s %.3f s (%s crossings)' % (layout, t, '-' if crossings is None else crossings), end = '')
+            print()
+
+
+
+def bench_load_step(step_filename, repeats = 5):
+
+    # Throughput (MB/s) of tokeniser alone and of full "load_step"
+    size = os.path.getsize(step_filename)/1e6
+
+    def tokenise():
+        with open(step_filename, 'rb') as f:
+            for el in iter_entities(f, types = STEP_TYPES):
+                pass
+
+    def load():
+        StepParse().load_step(step_filename)
+
+    t_tok  = best_time(tokenise, repeats)
+    t_load = best_time(load, repeats)
+    print('%s: %.2f MB' % (step_filename, size))
+    print('  tokenise:  %8.3f s, %8.1f MB/s' % (t_tok, size/t_tok))
+    print('  load_step: %8.3f s, %8.1f MB/s' % (t_load, size/t_load))
+
+
+
+def bench_workers(step_filename, max_workers = None, repeats = 3):
+
+    # Speedup of parallel "load_step" vs number of worker processes
+    # Skipped on single core, where workers only add overhead
+    if os.cpu_count() == 1:
+        print('%s: single core, parallel parsing not benchmarked' % step_filename)
+        return
+    max_workers = max_workers or os.cpu_count()
+    size = os.path.getsize(step_filename)/1e6
+    t_1  = best_time(lambda: StepParse().load_step(step_filename), repeats)
+    print('%s: %.2f MB, %i cores' % (step_filename, size, os.cpu_count()))
+    print('  workers =  1: %8.3f s, %8.1f MB/s' % (t_1, size/t_1))
+    workers = 2
+    while workers <= max_workers:
+        t_n = best_time(lambda: StepParse().load_step(step_filename, workers = workers), repeats)
+        print('  workers = %2i: %8.3f s, %8.1f MB/s, speedup = %.2f' % (workers, t_n, size/t_n, t_1/t_n))
+        workers *= 2
+
+
+
+def check_parse_modes(step_filename = 'check_parse_modes.STEP', workers = 4):
+
+    # Check default, memory-mapped and parallel "load_step" give same part names for synthetic
+    # file with "/*", "*/" and ";" followed by "#<id> =" within strings, so comments must not be
+    # blanked within strings and ranges may be split at false entity boundaries
+    text = " /* x */ ;\n#1 = ''y'' */ ;#2=" * 4
+    make_synthetic_step(step_filename, n_parts = 100, filler = 20000, text = text)
+    try:
+        names = []
+        for kwargs in ({}, {'use_mmap': True}, {'workers': workers}):
+            assembly = StepParse()
+            assembly.load_step(step_filename, **kwargs)
+            names.append({k: assembly.part_dict[k] for k in assembly.part_dict})
+            assembly.close()
+        print('%s: %i parts, same names in default, mmap and parallel load: %s, names kept: %s'
+              % (step_filename, len(names[0]), names[0] == names[1] == names[2],
+                 all(el.endswith(text.replace("''", "'")) for el in names[0].values() if el.startswith('PART'))))
+    finally:
+        os.remove(step_filename)
+
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description = 'Benchmarks for step_parse_5_2')
+    parser.add_argument('filenames', nargs = '*', default = ['Torch Assembly.STEP'])
+    parser.add_argument('--workers', type = int, default = 0,
+                        help = 'also benchmark parallel parsing with up to this many workers')
+    parser.add_argument('--synthetic', type = int, default = 0,
+                        help = 'benchmark synthetic file of this many MB (approx.) instead')
+    parser.add_argument('--tree', action = 'store_true',
+                        help = 'benchmark tree construction on synthetic assemblies instead')
+    parser.add_argument('--lattice', action = 'store_true',
+                        help = 'benchmark lattice layout on synthetic assemblies instead')
+    parser.add_argument('--check', action = 'store_true',
+                        help = 'check parse modes agree on synthetic file with comments in strings instead')
+    args = parser.parse_args()
+
+    if args.check:
+        check_parse_modes()
+        raise SystemExit
+
+    if args.tree:
+        bench_create_tree()
+        bench_get_levels()
+        print('Tree memory:')
+        bench_tree_memory()
+        raise SystemExit
+
+    if args.lattice:
+        bench_lattice()
+        bench_layouts()
+        raise SystemExit
+
+    filenames = args.filenames
+    if args.synthetic:
+        filenames = ['synthetic_%iMB.STEP' % args.synthetic]
+        make_synthetic_step(filenames[0], n_parts = 1000, filler = args.synthetic*14000)
+
+    for filename in filenames:
+        bench_load_step(filename)
+        if args.workers:
+            bench_workers(filename, args.workers)
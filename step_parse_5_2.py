@@ -18,6 +18,7 @@
 import re
 
 # For powerset construction
+# For lattices of more than a few parts, see "PartLattice"
 from itertools import chain, combinations
 
 def powerset(iterable):
@@ -28,161 +29,1983 @@ def powerset(iterable):
 # Import networkx for plotting lattice
 import networkx as nx
 
+# For copies of assembly used to lay out lattice in background
+import copy
+
+# For compact arrays in assembly tree
+import numpy as np
+
+# For layered lattice layout, optional
+try:
+    from scipy import sparse
+except ImportError:
+    sparse = None
+
 # Random number generator
 #from random import randrange
 
-# TH: Import treelib for drawing a tree stucture
-# pip install --upgrade ete3
-#from treelib import Node
-from treelib import Tree
+# TH: Import treelib for drawing a tree stucture
+# pip install --upgrade ete3
+#from treelib import Node
+from treelib import Tree
+from treelib.exceptions import (DuplicatedNodeIdError, LoopError, MultipleRootError,
+                                NodeIDAbsentError, NodePropertyError)
+
+# Import "anytree" as well as "treelib" as better rendering capabilities
+#from anytree import AnyNode, Node, RenderTree
+
+#TH: useful for working with files
+import os
+
+# For memory-mapped STEP file access
+import mmap
+from collections.abc import Mapping, MutableMapping
+
+# For parallel parsing of large STEP files and batch processing
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import glob
+import signal
+import time
+
+import sys
+
+#TH: for exporting to json format
+import json
+
+# For command-line use
+import argparse
+
+# For compressed STEP files
+import gzip
+import zipfile
+
+# For on-disk cache of parsed assemblies
+import hashlib
+import pickle
+import zlib
+
+# HR Oct 19
+# Allow stdout to be captured for later use
+from io import StringIO
+
+
+
+class Capture(list):
+
+    # Class for capturing stdout
+    def __enter__(self):
+        self._stdout = sys.stdout
+        sys.stdout = self._stringio = StringIO()
+        return self
+
+    def __exit__(self, *args):
+        self.extend(self._stringio.getvalue().splitlines())
+        del self._stringio
+        sys.stdout = self._stdout
+
+
+
+### ---
+# ISO 10303-21 (STEP Part 21) tokeniser
+# ---
+# File is read in binary chunks and split into statements at ";" terminators,
+# with terminators inside strings and comments ignored; statements are then
+# matched against entity instance header, e.g. "#12 = PRODUCT ( ... )"
+# or "#7 = ( A ( ... ) B ( ... ) )" for complex entities (type is empty)
+### ---
+
+# Entity types needed for product structure, mapped to type of line/ref list they populate
+STEP_TYPES = {b'NEXT_ASSEMBLY_USAGE_OCCURRENCE':                     'nauo',
+              b'PRODUCT_DEFINITION':                                 'prod_def',
+              b'PRODUCT_DEFINITION_WITH_ASSOCIATED_DOCUMENTS':       'prod_def',
+              b'PRODUCT_DEFINITION_FORMATION':                       'prod_def_form',
+              b'PRODUCT_DEFINITION_FORMATION_WITH_SPECIFIED_SOURCE': 'prod_def_form',
+              b'PRODUCT':                                            'prod'}
+
+# Size of chunks read from STEP file
+CHUNK_SIZE = 1 << 22
+
+_entity_head  = re.compile(rb'\s*#(\d+)\s*=\s*([A-Za-z_][A-Za-z0-9_]*)?\s*\(')
+_keyword_head = re.compile(rb'\s*([A-Za-z_][A-Za-z0-9_-]*)')
+_lexeme       = re.compile(rb"'|/\*|\*/")
+_string       = re.compile(rb"'[^']*(?:''[^']*)*'")
+_ref          = re.compile(rb'#\d+')
+
+
+
+def _scan_lexemes(piece, quoted, comment):
+    # Slow path for statement fragments containing comments:
+    # track whether end of fragment is within string or comment
+    for m in _lexeme.finditer(piece):
+        lexeme = m.group()
+        if comment:
+            if lexeme == b'*/':
+                comment = False
+        elif lexeme == b"'":
+            quoted = not quoted
+        elif lexeme == b'/*' and not quoted:
+            comment = True
+    return quoted, comment
+
+
+
+def _blank_comments(statement):
+    # Replace comments in statement with spaces, preserving offsets;
+    # "/*" and "*/" within strings are not comments, so are kept
+    spans   = []
+    quoted  = False
+    comment = None
+    for m in _lexeme.finditer(statement):
+        lexeme = m.group()
+        if comment is not None:
+            if lexeme == b'*/':
+                spans.append((comment, m.end()))
+                comment = None
+        elif lexeme == b"'":
+            quoted = not quoted
+        elif lexeme == b'/*' and not quoted:
+            comment = m.start()
+    if comment is not None:
+        spans.append((comment, len(statement)))
+    pieces = []
+    end    = 0
+    for start, stop in spans:
+        pieces += [statement[end:start], b' '*(stop - start)]
+        end = stop
+    pieces.append(statement[end:])
+    return b''.join(pieces)
+
+
+
+class LoadCancelled(Exception):
+    pass
+
+
+
+class UnterminatedStatement(Exception):
+    pass
+
+
+
+def iter_statements(f, offset = 0, chunk_size = CHUNK_SIZE, progress = None, strict = False):
+
+    # Yield (stream offset, statement) for all ";"-terminated statements in file object "f"
+    # Statements are bytes and exclude terminator; an unterminated trailing statement is dropped
+    # Comments are blanked out with spaces, preserving offsets, but not "/*" or "*/" within strings
+    # ---
+    # If "progress" given, it is called with stream offset of end of data read once statements
+    # in each chunk have been yielded; parsing is aborted with "LoadCancelled" if it returns False
+    # If "strict", "UnterminatedStatement" is raised if data ends within statement, string or comment
+    held    = []
+    tail    = b''
+    quoted  = False
+    comment = False
+    blank   = False
+    read    = offset
+    while True:
+        chunk = f.read(chunk_size)
+        if not chunk:
+            break
+        read += len(chunk)
+        data   = tail + chunk
+        pieces = data.split(b';')
+        tail   = pieces.pop()
+        # Only look for comments within pieces if there are any in chunk
+        comments = comment or b'/*' in data
+        for piece in pieces:
+            # Fast path: toggle string state if odd number of quotes
+            # ("''" escapes within strings always come in pairs)
+            if comments and (comment or b'/*' in piece):
+                quoted, comment = _scan_lexemes(piece, quoted, comment)
+                blank = True
+            elif piece.count(b"'") & 1:
+                quoted = not quoted
+            if held or quoted or comment:
+                held.append(piece)
+                if quoted or comment:
+                    continue
+                piece = b';'.join(held)
+                held  = []
+            if blank:
+                piece = _blank_comments(piece)
+                blank = False
+            yield offset, piece
+            offset += len(piece) + 1
+        if progress is not None and progress(read) is False:
+            raise LoadCancelled()
+    if strict and (held or quoted or comment or tail.strip()):
+        raise UnterminatedStatement(offset)
+
+
+
+def iter_entities(f, offset = 0, in_data = False, types = None, chunk_size = CHUNK_SIZE, progress = None,
+                  strict = False):
+
+    # Yield (id, type, args start, args end, args) for entity instances in DATA section(s) of "f"
+    # ---
+    # "id", "type" and "args" are bytes, e.g. b'12', b'PRODUCT', b"'name', ..."
+    # "start" and "end" are stream offsets of raw argument list
+    # If "types" given, only entities of those types are yielded
+    # If "progress" given, it is called with (stream offset, no. of entities yielded so far)
+    # after each chunk is read, and "strict" applies, as for "iter_statements"
+    count  = 0
+    report = None
+    if progress is not None:
+        report = lambda pos: progress(pos, count)
+    for start, statement in iter_statements(f, offset, chunk_size, report, strict):
+        m = _entity_head.match(statement)
+        if m:
+            if in_data:
+                type_ = m.group(2) or b''
+                if types is None or type_ in types:
+                    count     += 1
+                    args_start = m.end()
+                    args_end   = statement.rfind(b')')
+                    yield m.group(1), type_, start + args_start, start + args_end, statement[args_start:args_end]
+            continue
+        # Otherwise check for start/end of section
+        m = _keyword_head.match(statement)
+        if m:
+            keyword = m.group(1).upper()
+            if keyword == b'DATA':
+                in_data = True
+            elif keyword == b'ENDSEC':
+                in_data = False
+
+
+
+def decode_step(b):
+
+    # Decode bytes from STEP file; files should be ASCII but UTF-8 and Latin-1 are common
+    try:
+        return b.decode('utf-8')
+    except UnicodeDecodeError:
+        return b.decode('latin-1')
+
+
+
+def get_refs(args):
+
+    # Get all "#" references in raw argument list, ignoring any within strings
+    if b"'" in args:
+        args = _string.sub(b"''", args)
+    return [el.decode() for el in _ref.findall(args)]
+
+
+
+def get_first_string(args):
+
+    # Get first string in raw argument list, with "''" unescaped
+    m = _string.search(args)
+    if m:
+        return decode_step(m.group()[1:-1].replace(b"''", b"'"))
+    return ''
+
+
+
+### ---
+# Compressed STEP files
+# ---
+# gzip files and zip archives (including STEP-Z, ".stpZ") are read as a
+# decompressed stream, without temporary files
+### ---
+
+# Extensions of compressed files, stripped along with STEP extension in "get_step_basename"
+COMPRESSED_EXTS = ('.gz', '.zip', '.stpz')
+
+_gzip_magic = b'\x1f\x8b'
+_zip_magic  = b'PK\x03\x04'
+
+
+
+def is_compressed(step_filename):
+
+    # Check for gzip or zip file from first bytes
+    with open(step_filename, 'rb') as f:
+        magic = f.read(4)
+    return magic.startswith(_gzip_magic) or magic == _zip_magic
+
+
+
+def open_step(step_filename):
+
+    # Open STEP file as binary stream, decompressing if necessary
+    # For zip archives, first member with STEP extension is used (or first member if none)
+    with open(step_filename, 'rb') as f:
+        magic = f.read(4)
+    if magic.startswith(_gzip_magic):
+        return gzip.open(step_filename, 'rb')
+    if magic == _zip_magic:
+        # Archive closed once member opened: underlying file is then closed with member
+        with zipfile.ZipFile(step_filename) as archive:
+            names = [el for el in archive.namelist() if not el.endswith('/')]
+            step_names = [el for el in names if os.path.splitext(el)[1].lower() in ('.stp', '.step', '.p21')]
+            if not names:
+                raise ValueError('No files in zip archive: ' + step_filename)
+            return archive.open((step_names or names)[0])
+    return open(step_filename, 'rb')
+
+
+
+def get_step_basename(step_filename):
+
+    # Strip extension from STEP file name, plus compression extension, e.g. "a.stp.gz" -> "a"
+    name, ext = os.path.splitext(step_filename)
+    if ext.lower() in COMPRESSED_EXTS:
+        name_, ext_ = os.path.splitext(name)
+        if ext_.lower() in ('.stp', '.step', '.p21'):
+            name = name_
+    return name
+
+
+
+def collect_entities(entities_in, keep_lines = True):
+
+    # Build entity table, ref lists, (optionally) raw lines and fingerprints (CRC-32 of raw arguments,
+    # for detecting changes on reload) from "iter_entities" output
+    # ---
+    # Ref lists contain entity ref then all "#" refs in its arguments, ignoring any within strings;
+    # "PRODUCT" refs also have product name (first string) appended, or, if not "keep_lines",
+    # the (start, end) offsets of the name in the file, to be decoded later via "StepNames"
+    entities     = {}
+    refs_dict    = {el:[] for el in set(STEP_TYPES.values())}
+    lines_dict   = {el:[] for el in set(STEP_TYPES.values())}
+    fingerprints = {}
+    for id_, type_, start, end, args in entities_in:
+        ref       = '#' + id_.decode()
+        line_type = STEP_TYPES[type_]
+        type_     = type_.decode()
+        entities[ref]     = (type_, start, end)
+        fingerprints[ref] = zlib.crc32(args)
+        refs = [ref] + get_refs(args)
+        if line_type == 'prod':
+            if keep_lines:
+                refs.append(get_first_string(args))
+            else:
+                m = _string.search(args)
+                refs.append((start + m.start() + 1, start + m.end() - 1) if m else '')
+        refs_dict[line_type].append(refs)
+        if keep_lines:
+            lines_dict[line_type].append(ref + ' = ' + type_ + ' ( ' + decode_step(args) + ' ) ;')
+
+    return entities, refs_dict, lines_dict, fingerprints
+
+
+
+### ---
+# Parallel parsing
+# ---
+# DATA section is split into byte ranges aligned to entity boundaries, i.e. to a ";"
+# followed by the start of the next entity instance; ranges are parsed in worker
+# processes and the partial tables are merged in file order
+### ---
+
+# Minimum size of byte range given to each worker
+MIN_RANGE_SIZE = 1 << 20
+
+_entity_boundary = re.compile(rb';\s*#\d+\s*=')
+
+
+
+class RangeReader:
+
+    # Read-only file wrapper limited to byte range [start, end)
+    def __init__(self, f, start, end):
+        self.f = f
+        self.f.seek(start)
+        self.remaining = end - start
+
+    def read(self, size = -1):
+        if size < 0 or size > self.remaining:
+            size = self.remaining
+        data = self.f.read(size)
+        self.remaining -= len(data)
+        return data
+
+
+
+def find_data_start(f):
+
+    # Get offset just after "DATA;" statement, or None if not found
+    for start, statement in iter_statements(f, chunk_size = 1 << 16):
+        if statement.strip().upper().startswith(b'DATA'):
+            return start + len(statement) + 1
+    return None
+
+
+
+def find_entity_boundary(f, pos, end, window = 1 << 16):
+
+    # Get offset of first entity boundary at or after "pos", or "end" if none
+    # ---
+    # A ";" followed by "#<id> =" within a string or comment gives a false boundary, which is
+    # found when range before it is parsed, see "parse_parallel"
+    while pos < end:
+        f.seek(pos)
+        data = f.read(min(window, end - pos) + 64)
+        m = _entity_boundary.search(data)
+        if m and pos + m.start() < end:
+            return pos + m.start() + 1
+        pos += window
+    return end
+
+
+
+def get_ranges(step_filename, workers):
+
+    # Split DATA section of STEP file into at most "workers" byte ranges aligned to entity boundaries
+    with open(step_filename, 'rb') as f:
+        size  = os.fstat(f.fileno()).st_size
+        start = find_data_start(f)
+        if start is None:
+            return []
+        n = max(1, min(workers, (size - start)//MIN_RANGE_SIZE))
+        bounds = [start]
+        for i in range(1, n):
+            pos = find_entity_boundary(f, max(bounds[-1], start + i*(size - start)//n), size)
+            if pos < size:
+                bounds.append(pos)
+        bounds.append(size)
+    return list(zip(bounds[:-1], bounds[1:]))
+
+
+
+def parse_range(step_filename, start, end, keep_lines = True):
+
+    # Parse entities in byte range of STEP file (worker function)
+    # Raises "UnterminatedStatement" if range ends within string or comment, i.e. at false boundary
+    with open(step_filename, 'rb') as f:
+        reader = RangeReader(f, start, end)
+        return collect_entities(iter_entities(reader, offset = start, in_data = True, types = STEP_TYPES,
+                                              strict = True), keep_lines)
+
+
+
+def parse_parallel(step_filename, workers, keep_lines = True, progress = None):
+
+    # Parse STEP file in parallel across "workers" processes,
+    # returning merged entity table, ref lists, lines and fingerprints as from "collect_entities"
+    # If "progress" given, it is called as for "iter_entities" as each range is merged,
+    # and remaining ranges are abandoned if it returns False
+    # ---
+    # Ranges are split without tracking strings and comments, but first range starts at
+    # "DATA;", so each boundary is true if range before it started at true boundary and ended
+    # outside any statement; at first range that doesn't, rest of file is parsed serially
+    ranges = get_ranges(step_filename, workers)
+    if len(ranges) < 2:
+        with open(step_filename, 'rb') as f:
+            return collect_entities(iter_entities(f, types = STEP_TYPES, progress = progress), keep_lines)
+
+    entities     = {}
+    refs_dict    = {el:[] for el in set(STEP_TYPES.values())}
+    lines_dict   = {el:[] for el in set(STEP_TYPES.values())}
+    fingerprints = {}
+
+    def merge(table):
+        entities_, refs_dict_, lines_dict_, fingerprints_ = table
+        entities.update(entities_)
+        fingerprints.update(fingerprints_)
+        for k in refs_dict:
+            refs_dict[k].extend(refs_dict_[k])
+            lines_dict[k].extend(lines_dict_[k])
+
+    with ProcessPoolExecutor(max_workers = len(ranges)) as executor:
+        futures = [executor.submit(parse_range, step_filename, start, end, keep_lines) for start, end in ranges]
+        for future, (start, end) in zip(futures, ranges):
+            try:
+                merge(future.result())
+            except UnterminatedStatement:
+                executor.shutdown(cancel_futures = True)
+                report = None
+                if progress is not None:
+                    n_merged = len(entities)
+                    report   = lambda pos, count: progress(pos, n_merged + count)
+                with open(step_filename, 'rb') as f:
+                    f.seek(start)
+                    merge(collect_entities(iter_entities(f, offset = start, in_data = True, types = STEP_TYPES,
+                                                         progress = report), keep_lines))
+                break
+            if progress is not None and progress(end, len(entities)) is False:
+                executor.shutdown(cancel_futures = True)
+                raise LoadCancelled()
+
+    return entities, refs_dict, lines_dict, fingerprints
+
+
+
+class StepNames(MutableMapping):
+
+    # Dictionary of names, some of which may be (start, end) offsets of names
+    # in (memory-mapped) STEP file, decoded and cached only when looked up
+    def __init__(self, buffer, names):
+        self.buffer = buffer
+        self.names  = names
+
+    def __getitem__(self, key):
+        name = self.names[key]
+        if isinstance(name, tuple):
+            name = decode_step(self.buffer[name[0]:name[1]].replace(b"''", b"'"))
+            self.names[key] = name
+        return name
+
+    def __setitem__(self, key, value):
+        self.names[key] = value
+
+    def __delitem__(self, key):
+        del self.names[key]
+
+    def __iter__(self):
+        return iter(self.names)
+
+    def __len__(self):
+        return len(self.names)
+
+    def __contains__(self, key):
+        return key in self.names
+
+
+
+### ---
+# On-disk cache of parsed assemblies
+# ---
+# Cache files are compressed pickles named by SHA-1 of STEP file content, parser version and
+# maximum tree size, as trees limited to different sizes are created to different depths;
+# an index maps file path, size and modification time to content hash so that unchanged
+# files are not rehashed; least recently used files are evicted beyond "max_size" bytes
+### ---
+
+# Increment when parsed data changes, to invalidate existing cache files
+PARSER_VERSION = 4
+
+
+
+class StepCache:
+
+    def __init__(self, path = None, max_size = 256 << 20):
+        if path is None:
+            path = os.path.join(os.path.expanduser('~'), '.strembed_cache')
+        self.path       = path
+        self.max_size   = max_size
+        self.index_file = os.path.join(path, 'index.json')
+        os.makedirs(path, exist_ok = True)
+        try:
+            with open(self.index_file) as f:
+                self.index = json.load(f)
+        except (OSError, ValueError):
+            self.index = {}
+
+
+
+    def get_key(self, step_filename):
+
+        # Get content hash of STEP file, via index if size and modification time unchanged
+        filename = os.path.abspath(step_filename)
+        stat     = os.stat(filename)
+        entry    = self.index.get(filename)
+        if entry and entry[0] == stat.st_size and entry[1] == stat.st_mtime_ns:
+            return entry[2]
+
+        sha = hashlib.sha1()
+        with open(filename, 'rb') as f:
+            for block in iter(lambda: f.read(1 << 20), b''):
+                sha.update(block)
+        key = sha.hexdigest()
+        self.index[filename] = [stat.st_size, stat.st_mtime_ns, key]
+        self.save_index()
+        return key
+
+
+
+    def get_cache_file(self, key, max_tree_size = None):
+        size = 'full' if max_tree_size is None else 't%i' % max_tree_size
+        return os.path.join(self.path, '%s_v%i_%s.strembed' % (key, PARSER_VERSION, size))
+
+
+
+    def get(self, step_filename, max_tree_size = None):
+
+        # Get cached data for STEP file with tree created with given "max_tree_size", or None if not cached
+        cache_file = self.get_cache_file(self.get_key(step_filename), max_tree_size)
+        try:
+            with open(cache_file, 'rb') as f:
+                data = pickle.loads(zlib.decompress(f.read()))
+        except (OSError, ValueError, zlib.error, pickle.UnpicklingError, EOFError):
+            return None
+        # Update modification time, as used for LRU eviction
+        os.utime(cache_file)
+        return data
+
+
+
+    def put(self, step_filename, data, max_tree_size = None):
+
+        # Add data for STEP file to cache, then evict least recently used files if necessary
+        cache_file = self.get_cache_file(self.get_key(step_filename), max_tree_size)
+        temp_file  = cache_file + '.tmp'
+        with open(temp_file, 'wb') as f:
+            f.write(zlib.compress(pickle.dumps(data, pickle.HIGHEST_PROTOCOL)))
+        os.replace(temp_file, cache_file)
+        self.evict()
+
+
+
+    def evict(self):
+
+        # Remove least recently used cache files until total size within "max_size"
+        files = []
+        for el in os.listdir(self.path):
+            if el.endswith('.strembed'):
+                stat = os.stat(os.path.join(self.path, el))
+                files.append((stat.st_mtime, stat.st_size, el))
+        total = sum(el[1] for el in files)
+        removed = set()
+        for mtime, size, el in sorted(files):
+            if total <= self.max_size:
+                break
+            os.remove(os.path.join(self.path, el))
+            removed.add(el.split('_')[0])
+            total -= size
+
+        # Drop index entries for evicted files
+        if removed:
+            self.index = {k:v for k,v in self.index.items() if v[2] not in removed}
+            self.save_index()
+
+
+
+    def save_index(self):
+        temp_file = self.index_file + '.tmp'
+        with open(temp_file, 'w') as f:
+            json.dump(self.index, f)
+        os.replace(temp_file, self.index_file)
+
+
+
+### ---
+# Compact assembly tree
+# ---
+# Array-backed replacement for treelib "Tree", with same interface as used here and in GUI
+# (create_node, move_node, remove_node, update_node, parent, children, is_branch, leaves,
+# depth, level, size, nodes, get_node, root, show, to_json); node IDs are non-negative integers
+# ---
+# Parent of each node is held in array indexed by node ID, labels and refs are interned,
+# and child lists are held in compressed sparse row (CSR) form, rebuilt in one pass when needed
+# after nodes are added or moved; nodes are returned as lightweight "AssemblyNode" views
+# ---
+# Euler-tour (pre-order entry/exit) index, rebuilt with child lists, gives descendants,
+# ancestor tests and subtree sizes without walking tree, see "get_euler_index"; with
+# binary-lifting table of ancestors, also lowest common ancestors, see "get_lca"
+# ---
+# Edits can be recorded for incremental updates, see "track_changes"
+# ---
+# Use "to_treelib" to get treelib "Tree", e.g. for export
+### ---
+
+# Absent and root entries in parent array
+NO_NODE = -2
+NO_PARENT = -1
+
+
+
+class AssemblyNode:
+
+    # View of node in "AssemblyTree", with attributes of treelib "Node"
+    __slots__ = ('tree', 'identifier')
+
+    def __init__(self, tree, identifier):
+        self.tree       = tree
+        self.identifier = identifier
+
+    @property
+    def tag(self):
+        return self.tree.labels[self.tree._label[self.identifier]]
+
+    @tag.setter
+    def tag(self, value):
+        self.tree._label[self.identifier] = self.tree.intern_label(value)
+        if self.tree._relabelled is not None:
+            self.tree._relabelled.add(self.identifier)
+
+    @property
+    def data(self):
+        # Data other than part ref held separately, as rare
+        if self.identifier in self.tree._data:
+            return self.tree._data[self.identifier]
+        ref = self.tree._ref[self.identifier]
+        return {'ref': self.tree.refs[ref]} if ref >= 0 else None
+
+    @data.setter
+    def data(self, value):
+        tree = self.tree
+        tree._data.pop(self.identifier, None)
+        if isinstance(value, dict) and list(value) == ['ref']:
+            tree._ref[self.identifier] = tree.intern_ref(value['ref'])
+        else:
+            tree._ref[self.identifier] = -1
+            if value is not None:
+                tree._data[self.identifier] = value
+
+    def is_leaf(self):
+        return not self.tree.is_branch(self.identifier)
+
+    def __eq__(self, other):
+        return isinstance(other, AssemblyNode) and other.tree is self.tree and other.identifier == self.identifier
+
+    def __hash__(self):
+        return hash(self.identifier)
+
+    def __repr__(self):
+        return 'AssemblyNode(tag=%r, identifier=%r, data=%r)' % (self.tag, self.identifier, self.data)
+
+
+
+class AssemblyNodes(Mapping):
+
+    # Node ID -> "AssemblyNode" mapping of "AssemblyTree", as treelib "Tree.nodes"
+    # Iterates in order of node ID, i.e. in order of creation
+    __slots__ = ('tree',)
+
+    def __init__(self, tree):
+        self.tree = tree
+
+    def __getitem__(self, id_):
+        if id_ not in self.tree:
+            raise KeyError(id_)
+        return AssemblyNode(self.tree, id_)
+
+    def __iter__(self):
+        return iter(self.tree.get_ids().tolist())
+
+    def __len__(self):
+        return self.tree.size()
+
+    def __contains__(self, id_):
+        return id_ in self.tree
+
+
+
+class AssemblyTree:
+
+    __slots__ = ('_parent', '_seq', '_label', '_ref', '_data', 'labels', '_label_index', 'refs', '_ref_index',
+                 'root', '_size', '_next_seq', '_order', '_indptr', '_depth', '_tin', '_tout', '_tsize', '_euler', '_up',
+                 '_changed', '_removed', '_relabelled')
+
+    def __init__(self, capacity = 1024):
+        self._parent = np.full(capacity, NO_NODE, dtype = np.int64)
+        # Order in which nodes were added to their current parent, for ordering of children
+        self._seq    = np.zeros(capacity, dtype = np.int64)
+        self._label  = np.zeros(capacity, dtype = np.int32)
+        self._ref    = np.full(capacity, -1, dtype = np.int32)
+        self._data   = {}
+        self.labels       = []
+        self._label_index = {}
+        self.refs         = []
+        self._ref_index   = {}
+        self.root      = None
+        self._size     = 0
+        self._next_seq = 0
+        self._changed    = None
+        self._removed    = None
+        self._relabelled = None
+        self.invalidate()
+
+
+
+    def invalidate(self):
+        # Discard child index, depths and Euler-tour index after nodes added or moved
+        self._order  = None
+        self._indptr = None
+        self._depth  = None
+        self._tin    = None
+        self._tout   = None
+        self._tsize  = None
+        self._euler  = None
+        self._up     = None
+
+
+
+    def track_changes(self):
+
+        # Start recording edits, discarding any recorded so far
+        self._changed    = set()
+        self._removed    = set()
+        self._relabelled = set()
+
+
+
+    def pop_changes(self):
+
+        # Get sets of IDs of nodes (changed, removed, relabelled) since "track_changes" or last call
+        # "changed" nodes are those added or moved and those whose children have changed
+        changes = (self._changed or set(), self._removed or set(), self._relabelled or set())
+        if self._changed is not None:
+            self.track_changes()
+        return changes
+
+
+
+    def intern_label(self, label):
+        i = self._label_index.get(label)
+        if i is None:
+            i = self._label_index[label] = len(self.labels)
+            self.labels.append(label)
+        return i
+
+    def intern_ref(self, ref):
+        i = self._ref_index.get(ref)
+        if i is None:
+            i = self._ref_index[ref] = len(self.refs)
+            self.refs.append(ref)
+        return i
+
+
+
+    def grow(self, id_):
+        # Enlarge arrays to hold node "id_", doubling capacity
+        capacity = len(self._parent)
+        if id_ < capacity:
+            return
+        new_capacity = max(2*capacity, id_ + 1)
+        for name, fill in (('_parent', NO_NODE), ('_seq', 0), ('_label', 0), ('_ref', -1)):
+            old = getattr(self, name)
+            new = np.full(new_capacity, fill, dtype = old.dtype)
+            new[:capacity] = old
+            setattr(self, name, new)
+
+
+
+    def copy(self):
+
+        # Copy of tree structure that can be read while this tree is edited, e.g. in another thread
+        # Node data are copied shallowly; label and ref lists are shared, as only ever appended to;
+        # indexes are rebuilt when needed and edits are not tracked
+        tree = AssemblyTree.__new__(AssemblyTree)
+        for name in ('_parent', '_seq', '_label', '_ref'):
+            setattr(tree, name, getattr(self, name).copy())
+        tree._data        = dict(self._data)
+        tree.labels       = self.labels
+        tree._label_index = self._label_index
+        tree.refs         = self.refs
+        tree._ref_index   = self._ref_index
+        tree.root      = self.root
+        tree._size     = self._size
+        tree._next_seq = self._next_seq
+        tree._changed    = None
+        tree._removed    = None
+        tree._relabelled = None
+        tree.invalidate()
+        return tree
+
+
+
+    def __contains__(self, id_):
+        return (isinstance(id_, (int, np.integer)) and 0 <= id_ < len(self._parent)
+                and self._parent[id_] != NO_NODE)
+
+    def __len__(self):
+        return self._size
+
+    def size(self, level = None):
+        if level is None:
+            return self._size
+        return int(np.count_nonzero(self.get_depths()[self.get_ids()] == level))
+
+    def contains(self, id_):
+        return id_ in self
+
+    @property
+    def nodes(self):
+        return AssemblyNodes(self)
+
+    def get_ids(self):
+        # Array of IDs of all nodes, in ascending order
+        return np.flatnonzero(self._parent != NO_NODE)
+
+    def get_node(self, id_):
+        return AssemblyNode(self, id_) if id_ in self else None
+
+    def all_nodes(self):
+        return [AssemblyNode(self, el) for el in self.get_ids().tolist()]
+
+    def all_nodes_itr(self):
+        return iter(self.all_nodes())
+
+    def check(self, id_):
+        if id_ not in self:
+            raise NodeIDAbsentError('Node "%s" is not in the tree' % id_)
+
+
+
+    def create_node(self, tag = None, identifier = None, parent = None, data = None):
+
+        # Add node, as treelib; returns "AssemblyNode"
+        if identifier is None:
+            ids = self.get_ids()
+            identifier = int(ids[-1]) + 1 if len(ids) else 0
+        if isinstance(parent, AssemblyNode):
+            parent = parent.identifier
+        if identifier in self:
+            raise DuplicatedNodeIdError('Cannot create node with ID "%s"' % identifier)
+        if not isinstance(identifier, (int, np.integer)) or identifier < 0:
+            raise ValueError('Node ID must be non-negative integer: %r' % (identifier,))
+        if parent is None:
+            if self.root is not None:
+                raise MultipleRootError('A tree takes one root merely')
+            self.root = identifier
+            parent = NO_PARENT
+        else:
+            self.check(parent)
+
+        self.grow(identifier)
+        self._parent[identifier] = parent
+        self._seq[identifier]    = self._next_seq
+        self._label[identifier]  = self.intern_label(tag if tag is not None else identifier)
+        self._next_seq += 1
+        self._size     += 1
+        node = AssemblyNode(self, identifier)
+        node.data = data
+        if self._changed is not None:
+            self._changed.add(identifier)
+            if parent >= 0:
+                self._changed.add(parent)
+        self.invalidate()
+        return node
+
+
+
+    def get_children_index(self):
+
+        # Get (order, indptr) where children of node "i" are order[indptr[i]:indptr[i + 1]],
+        # in order added; removed nodes may remain in "order" until next rebuild
+        if self._order is None:
+            ids = self.get_ids()
+            ids = ids[np.argsort(self._seq[ids], kind = 'stable')]
+            ids = ids[ids != self.root] if self.root is not None else ids
+            ids = ids[np.argsort(self._parent[ids], kind = 'stable')]
+            counts = np.bincount(self._parent[ids], minlength = len(self._parent))
+            self._indptr = np.zeros(len(self._parent) + 1, dtype = np.int64)
+            np.cumsum(counts, out = self._indptr[1:])
+            self._order  = ids
+        return self._order, self._indptr
+
+
+
+    def get_child_ids(self, id_):
+        # Array of IDs of children of node
+        order, indptr = self.get_children_index()
+        if id_ >= len(indptr) - 1:
+            return order[:0]
+        child_ids = order[indptr[id_]:indptr[id_ + 1]]
+        # Filter nodes removed or moved since index built
+        return child_ids[self._parent[child_ids] == id_]
+
+
+
+    def is_branch(self, id_):
+        self.check(id_)
+        return self.get_child_ids(id_).tolist()
+
+    def children(self, id_):
+        return [AssemblyNode(self, el) for el in self.is_branch(id_)]
+
+    def parent(self, id_):
+        self.check(id_)
+        parent = int(self._parent[id_])
+        return AssemblyNode(self, parent) if parent >= 0 else None
+
+    def get_parents(self):
+        # Parent array, indexed by node ID; -1 for root, -2 for no node
+        return self._parent
+
+    def get_tags(self, ids):
+        # List of tags of nodes with given IDs
+        return [self.labels[el] for el in self._label[ids].tolist()]
+
+    def get_refs(self, ids):
+        # List of part refs of nodes with given IDs, None where not set
+        return [self.refs[el] if el >= 0 else None for el in self._ref[ids].tolist()]
+
+    def get_leaf_ids(self):
+        # Array of IDs of all nodes without children, in ascending order
+        ids = self.get_ids()
+        has_children = np.zeros(len(self._parent), dtype = bool)
+        has_children[self._parent[ids][self._parent[ids] >= 0]] = True
+        return ids[~has_children[ids]]
+
+    def leaves(self, id_ = None):
+        if id_ is None:
+            return [AssemblyNode(self, el) for el in self.get_leaf_ids().tolist()]
+        return [AssemblyNode(self, el) for el in self.get_subtree_ids(id_) if not len(self.get_child_ids(el))]
+
+
+
+    def get_euler_index(self):
+
+        # Get (tin, tout, euler) where "euler" holds node IDs in pre-order (depth-first, in order
+        # of children) and node "i" and its descendants are euler[tin[i]:tout[i]]
+        # ---
+        # Computed without traversal: subtree sizes are summed up tree a depth at a time, then
+        # each node's entry index is its parent's plus one plus sizes of its preceding siblings
+        # Removing nodes leaves index valid, removed nodes being skipped in "euler"
+        if self._tin is None:
+            size   = len(self._parent)
+            depths = self.get_depths()
+            order, indptr = self.get_children_index()
+            ids    = self.get_ids()
+            ids    = ids[np.argsort(depths[ids], kind = 'stable')]
+            levels = np.split(ids, np.flatnonzero(np.diff(depths[ids])) + 1) if len(ids) else []
+
+            self._tsize = np.zeros(size, dtype = np.int64)
+            self._tsize[ids] = 1
+            for level in reversed(levels[1:]):
+                np.add.at(self._tsize, self._parent[level], self._tsize[level])
+
+            # Sizes of preceding siblings, from cumulative sum within each parent's block of children
+            # (removed nodes still in block have size zero)
+            sizes   = self._tsize[order]
+            before  = np.cumsum(sizes) - sizes
+            owner   = np.repeat(np.arange(size), np.diff(indptr))
+            offsets = np.zeros(size, dtype = np.int64)
+            offsets[order] = before - before[indptr[owner]] if len(order) else before
+
+            self._tin = np.full(size, -1, dtype = np.int64)
+            if self.root is not None:
+                self._tin[self.root] = 0
+            for level in levels[1:]:
+                self._tin[level] = self._tin[self._parent[level]] + 1 + offsets[level]
+            self._tout  = self._tin + self._tsize
+            self._euler = np.full(len(ids), NO_NODE, dtype = np.int64)
+            self._euler[self._tin[ids]] = ids
+        return self._tin, self._tout, self._euler
+
+
+
+    def is_ancestor(self, ancestor, id_):
+        # Whether node "ancestor" is ancestor of node "id_" (not node itself)
+        self.check(ancestor)
+        self.check(id_)
+        tin, tout, euler = self.get_euler_index()
+        return ancestor != id_ and tin[ancestor] <= tin[id_] < tout[ancestor]
+
+    def get_ancestor_table(self):
+
+        # Get binary-lifting table, where up[k, i] is 2**k-th ancestor of node "i" (root if none)
+        # Number of rows is number of bits in tree depth, so table is small unless tree very deep
+        if self._up is None:
+            depth  = self.depth()
+            parent = np.where(self._parent >= 0, self._parent, np.arange(len(self._parent)))
+            if self.root is not None:
+                parent[self.root] = self.root
+            up = [parent]
+            for k in range(1, max(1, depth.bit_length())):
+                up.append(up[-1][up[-1]])
+            self._up = np.array(up)
+        return self._up
+
+
+
+    def get_lca(self, id_1, id_2):
+
+        # Get lowest common ancestor of two nodes (one of them if ancestor of other), in O(log depth)
+        self.check(id_1)
+        self.check(id_2)
+        depths = self.get_depths()
+        up     = self.get_ancestor_table()
+        if depths[id_1] < depths[id_2]:
+            id_1, id_2 = id_2, id_1
+        # Lift deeper node to same depth, then both to just below common ancestor
+        diff = int(depths[id_1] - depths[id_2])
+        k = 0
+        while diff:
+            if diff & 1:
+                id_1 = int(up[k, id_1])
+            diff >>= 1
+            k += 1
+        if id_1 == id_2:
+            return id_1
+        for k in range(len(up) - 1, -1, -1):
+            if up[k, id_1] != up[k, id_2]:
+                id_1 = int(up[k, id_1])
+                id_2 = int(up[k, id_2])
+        return int(self._parent[id_1])
+
+
+
+    def get_common_ancestor(self, ids):
+
+        # Get lowest common ancestor of any number of nodes, i.e. that of first and last in pre-order,
+        # as all others lie between them in subtree of their common ancestor
+        ids = np.asarray(list(ids), dtype = np.int64)
+        for el in ids.tolist():
+            self.check(el)
+        tin, tout, euler = self.get_euler_index()
+        return self.get_lca(int(ids[np.argmin(tin[ids])]), int(ids[np.argmax(tin[ids])]))
+
+
+
+    def subtree_size(self, id_):
+        # Number of nodes in subtree of node, including node
+        self.check(id_)
+        self.get_euler_index()
+        return int(self._tsize[id_])
+
+    def get_descendant_ids(self, id_):
+        # Array of IDs of all descendants of node, in pre-order
+        self.check(id_)
+        tin, tout, euler = self.get_euler_index()
+        descendants = euler[tin[id_] + 1:tout[id_]]
+        return descendants[descendants >= 0]
+
+    def get_subtree_ids(self, id_):
+        # List of IDs of node and all its descendants, depth-first in order of children
+        return [id_] + self.get_descendant_ids(id_).tolist()
+
+
+
+    def get_depths(self):
+
+        # Array of depth of each node, indexed by node ID, computed level by level from root
+        if self._depth is None:
+            self._depth = np.full(len(self._parent), -1, dtype = np.int64)
+            if self.root is not None:
+                order, indptr = self.get_children_index()
+                level = np.array([self.root])
+                depth = 0
+                while len(level):
+                    self._depth[level] = depth
+                    starts = indptr[level]
+                    counts = indptr[level + 1] - starts
+                    # Concatenate children of all nodes in level
+                    offsets = np.repeat(starts - np.cumsum(counts) + counts, counts)
+                    level   = order[offsets + np.arange(counts.sum())]
+                    level   = level[self._parent[level] >= 0]
+                    depth += 1
+        return self._depth
+
+
+
+    def depth(self, node = None):
+        # Depth of node, or of tree if no node given
+        if node is None:
+            if self.root is None:
+                return 0
+            return int(self.get_depths().max())
+        if isinstance(node, AssemblyNode):
+            node = node.identifier
+        self.check(node)
+        return int(self.get_depths()[node])
+
+    def level(self, id_, filter = None):
+        return self.depth(id_)
+
+
+
+    def remove_node(self, id_):
+        # Remove node and its descendants; returns number of nodes removed
+        subtree = self.get_subtree_ids(id_)
+        parent  = int(self._parent[id_])
+        if self._changed is not None:
+            self._changed.difference_update(subtree)
+            self._relabelled.difference_update(subtree)
+            self._removed.update(subtree)
+            if self._parent[id_] >= 0:
+                self._changed.add(int(self._parent[id_]))
+        self._parent[subtree] = NO_NODE
+        self._ref[subtree]    = -1
+        for el in subtree:
+            self._data.pop(el, None)
+        if id_ == self.root:
+            self.root = None
+        self._size -= len(subtree)
+        if self._depth is not None:
+            self._depth[subtree] = -1
+        if self._tin is not None:
+            # Keep Euler-tour index valid: skip removed nodes and reduce sizes of ancestors
+            self._euler[self._tin[subtree]] = NO_NODE
+            el = parent
+            while el >= 0:
+                self._tsize[el] -= len(subtree)
+                el = int(self._parent[el])
+            self._tsize[subtree] = 0
+        return len(subtree)
+
+
+
+    def move_node(self, source, destination):
+        # Move node (with descendants) to be last child of "destination"
+        # Check via subtree index if current, else via ancestors of destination, as index
+        # is rebuilt after each move
+        self.check(source)
+        self.check(destination)
+        if self._tin is not None:
+            loop = source == destination or self.is_ancestor(source, destination)
+        else:
+            el = destination
+            while el >= 0 and el != source:
+                el = int(self._parent[el])
+            loop = el == source
+        if loop:
+            raise LoopError('Loop detected when moving node "%s" to "%s"' % (source, destination))
+        if self._changed is not None:
+            self._changed.update((source, destination, int(self._parent[source])))
+        self._parent[source] = destination
+        self._seq[source]    = self._next_seq
+        self._next_seq += 1
+        self.invalidate()
+
+
+
+    def update_node(self, id_, **attrs):
+        self.check(id_)
+        node = AssemblyNode(self, id_)
+        for k, v in attrs.items():
+            if k not in ('tag', 'data'):
+                raise NodePropertyError('Cannot update "%s" of node' % k)
+            setattr(node, k, v)
+
+
+
+    def to_treelib(self):
+        # Get equivalent treelib "Tree", parents being created before children
+        tree = Tree()
+        if self.root is None:
+            return tree
+        stack = [self.root]
+        while stack:
+            el     = stack.pop()
+            node   = AssemblyNode(self, el)
+            parent = int(self._parent[el])
+            tree.create_node(node.tag, el, parent = parent if parent >= 0 else None, data = node.data)
+            stack.extend(reversed(self.get_child_ids(el).tolist()))
+        return tree
+
+    def show(self, *args, **kwargs):
+        return self.to_treelib().show(*args, **kwargs)
+
+    def to_json(self, *args, **kwargs):
+        return self.to_treelib().to_json(*args, **kwargs)
+
+    def to_dict(self, *args, **kwargs):
+        return self.to_treelib().to_dict(*args, **kwargs)
+
+
+
+### ---
+# Boolean lattice of parts
+# ---
+# Each element of lattice is set of parts, held as bitset in Python int, bit "i" being part
+# "part_ids[i]"; meet and join are bitwise and/or, rank is number of parts (n_p)
+# ---
+# Parts are numbered in depth-first (pre-order) order of tree, so parts of any node are
+# contiguous bits and node's bitset is made from range in Euler-tour index, without storing it
+# Unexpanded assemblies have no children in tree, so count as single parts until expanded
+# ---
+# Elements are enumerated lazily, see "elements", as full powerset is not usable beyond
+# about 20 parts; lattice is not updated after tree edited, so create again if needed
+### ---
+
+def popcount(bits):
+    # Number of set bits, i.e. of parts in set
+    return bin(bits).count('1')
+
+
+
+class PartLattice:
+
+    def __init__(self, tree):
+
+        # Leaves of tree in pre-order, and for each node range of its parts [lo, hi)
+        tin, tout, euler = tree.get_euler_index()
+        ids     = tree.get_ids()
+        is_leaf = np.zeros(len(tin), dtype = bool)
+        is_leaf[tree.get_leaf_ids()] = True
+        is_part = np.zeros(len(euler), dtype = bool)
+        is_part[euler >= 0] = is_leaf[euler[euler >= 0]]
+        before  = np.zeros(len(euler) + 1, dtype = np.int64)
+        np.cumsum(is_part, out = before[1:])
+
+        self.tree     = tree
+        self.part_ids = euler[is_part]
+        self.lo       = np.zeros(len(tin), dtype = np.int64)
+        self.hi       = np.zeros(len(tin), dtype = np.int64)
+        self.lo[ids]  = before[tin[ids]]
+        self.hi[ids]  = before[tout[ids]]
+        self.part_index = dict(zip(self.part_ids.tolist(), range(len(self.part_ids))))
+
+        # Top and bottom of lattice, i.e. all parts and none
+        self.top    = (1 << len(self.part_ids)) - 1
+        self.bottom = 0
+
+
+
+    def __len__(self):
+        # Number of parts, i.e. atoms of lattice
+        return len(self.part_ids)
+
+
+
+    def get_bits(self, id_):
+        # Bitset of parts of node
+        self.tree.check(id_)
+        lo, hi = int(self.lo[id_]), int(self.hi[id_])
+        return ((1 << (hi - lo)) - 1) << lo
+
+    def get_ranks(self, ids = None):
+        # Ranks of nodes with given IDs (all nodes if None), i.e. numbers of parts, as array
+        if ids is None:
+            ids = self.tree.get_ids()
+        return self.hi[ids] - self.lo[ids]
+
+    def bits_from_ids(self, part_ids):
+        # Bitset of parts with given IDs
+        bits = 0
+        for el in part_ids:
+            bits |= 1 << self.part_index[el]
+        return bits
+
+    def ids_from_bits(self, bits):
+        # IDs of parts in bitset, in pre-order
+        ids = []
+        while bits:
+            low = bits & -bits
+            ids.append(int(self.part_ids[low.bit_length() - 1]))
+            bits ^= low
+        return ids
+
+
+
+    def rank(self, bits):
+        return popcount(bits)
+
+    def meet(self, *bits):
+        # Greatest lower bound, i.e. parts common to all
+        meet = self.top
+        for el in bits:
+            meet &= el
+        return meet
+
+    def join(self, *bits):
+        # Least upper bound, i.e. all parts of any
+        join = self.bottom
+        for el in bits:
+            join |= el
+        return join
+
+    def leq(self, bits_1, bits_2):
+        # Whether "bits_1" is below or equal to "bits_2", i.e. subset
+        return not bits_1 & ~bits_2
+
+    def covers(self, bits_1, bits_2):
+        # Whether "bits_2" covers "bits_1", i.e. has exactly one more part
+        return self.leq(bits_1, bits_2) and popcount(bits_1 ^ bits_2) == 1
+
+
+
+    def upper_covers(self, bits):
+        # Elements covering "bits", one part added
+        free = self.top & ~bits
+        while free:
+            low = free & -free
+            yield bits | low
+            free ^= low
+
+    def lower_covers(self, bits):
+        # Elements covered by "bits", one part removed
+        rest = bits
+        while rest:
+            low = rest & -rest
+            yield bits ^ low
+            rest ^= low
+
+
+
+    def elements(self, bottom = 0, top = None, ranks = None):
+
+        # Generate elements of interval [bottom, top] of lattice (whole lattice by default)
+        # in order of rank, optionally only those of given ranks, without creating all of them
+        # ---
+        # Elements of each rank are got from combinations of free bits, "top" less "bottom",
+        # in order of Gosper's hack, each free bit being mapped to its place in "top"
+        if top is None:
+            top = self.top
+        if not self.leq(bottom, top):
+            return
+        free = []
+        rest = top & ~bottom
+        while rest:
+            low = rest & -rest
+            free.append(low)
+            rest ^= low
+        n = len(free)
+        base = popcount(bottom)
+        if ranks is None:
+            ranks = range(base, base + n + 1)
+        for rank in sorted(ranks):
+            r = rank - base
+            if r < 0 or r > n:
+                continue
+            combo = (1 << r) - 1
+            while combo < 1 << n:
+                bits = bottom
+                rest = combo
+                while rest:
+                    low = rest & -rest
+                    bits |= free[low.bit_length() - 1]
+                    rest ^= low
+                yield bits
+                if not combo:
+                    break
+                # Next combination of same size (Gosper's hack)
+                low    = combo & -combo
+                ripple = combo + low
+                combo  = (((ripple ^ combo) >> 2)//low) | ripple
+
+
+
+    def get_node(self, bits):
+
+        # Get ID of smallest node containing all parts in "bits", i.e. its join within
+        # assembly structure, via lowest common ancestor; None if "bits" empty
+        if not bits:
+            return None
+        return self.tree.get_common_ancestor(self.ids_from_bits(bits))
+
+    def is_node(self, bits):
+        # Whether "bits" is exactly parts of some node, i.e. element in assembly structure
+        id_ = self.get_node(bits)
+        return id_ is not None and self.get_bits(id_) == bits
+
+
+
+### ---
+# Comparison of assembly structures
+# ---
+# Alternative configurations of same parts are compared by their sub-assemblies, each taken
+# as its set of parts ("cluster"); parts are matched between trees by key, e.g. tag, numbered
+# by path of keys from root so that repeated parts are distinct whatever order of siblings
+# ---
+# Each cluster is held as 128-bit sum of random codes of keys of its parts with number of parts,
+# i.e. as multiset of keys, summed up tree a depth at a time, so matching clusters of two trees
+# takes linear time; distance between structures is number of clusters in one but not other,
+# identical sub-assemblies counting once each
+### ---
+
+def get_part_keys(tree, key = 'tag'):
+
+    # Get (part IDs in pre-order, keys) for leaves of tree, each key being (tag, ref or ID, n)
+    # for n-th occurrence of that tag, ref or ID, ordered by path of keys from root
+    # ---
+    # Nodes are ranked a depth at a time by rank of parent then key, so rank orders paths and
+    # doesn't depend on order of siblings; occurrences on same path are interchangeable
+    ids = tree.get_ids()
+    if key == 'tag':
+        values = tree.get_tags(ids)
+    elif key == 'ref':
+        values = tree.get_refs(ids)
+    elif key == 'id':
+        values = ids.tolist()
+    else:
+        raise ValueError('Unknown part key: %s' % key)
+    table = sorted(set(values), key = repr)
+    index = {el: i for i, el in enumerate(table)}
+    codes = np.zeros(len(tree.get_parents()), dtype = np.int64)
+    codes[ids] = [index[el] for el in values]
+
+    parents = tree.get_parents()
+    depths  = tree.get_depths()
+    ranks   = np.zeros(len(parents), dtype = np.int64)
+    order   = ids[np.argsort(depths[ids], kind = 'stable')]
+    for level in np.split(order, np.flatnonzero(np.diff(depths[order])) + 1):
+        parent_ranks = ranks[parents[level]]
+        level = level[np.lexsort((codes[level], parent_ranks))]
+        parent_ranks = ranks[parents[level]]
+        new = np.r_[True, (np.diff(parent_ranks) != 0) | (np.diff(codes[level]) != 0)]
+        ranks[level] = np.cumsum(new) - 1
+
+    tin, tout, euler = tree.get_euler_index()
+    is_leaf = np.zeros(len(tin), dtype = bool)
+    is_leaf[tree.get_leaf_ids()] = True
+    part_ids = euler[euler >= 0]
+    part_ids = part_ids[is_leaf[part_ids]]
+
+    # Occurrences numbered within each key, by depth then rank of path
+    order  = np.lexsort((ranks[part_ids], depths[part_ids], codes[part_ids]))
+    starts = np.flatnonzero(np.r_[True, np.diff(codes[part_ids][order]) != 0])
+    n      = np.zeros(len(part_ids), dtype = np.int64)
+    n[order] = np.arange(len(order)) - np.repeat(starts, np.diff(np.r_[starts, len(order)]))
+    return part_ids, [(table[el], i) for el, i in zip(codes[part_ids].tolist(), n.tolist())]
+
+
+
+class AssemblySignature:
+
+    def __init__(self, tree, key = 'tag'):
+
+        # Codes of parts, from hash of key without occurrence number, so comparable between
+        # trees without shared table and same for all occurrences of repeated part
+        self.tree = tree
+        self.key  = key
+        self.part_ids, self.part_keys = get_part_keys(tree, key)
+        codes = np.frombuffer(b''.join(hashlib.blake2b(repr(el[0]).encode(), digest_size = 16).digest()
+                                       for el in self.part_keys), dtype = np.uint64).reshape(-1, 2)
+
+        # Sums of codes and numbers of parts of all nodes, up tree a depth at a time
+        parents = tree.get_parents()
+        depths  = tree.get_depths()
+        ids     = tree.get_ids()
+        self.sums   = np.zeros((len(parents), 2), dtype = np.uint64)
+        self.counts = np.zeros(len(parents), dtype = np.int64)
+        self.sums[self.part_ids]   = codes
+        self.counts[self.part_ids] = 1
+        order = ids[np.argsort(-depths[ids], kind = 'stable')]
+        for level in np.split(order, np.flatnonzero(np.diff(depths[order])) + 1):
+            level = level[parents[level] >= 0]
+            np.add.at(self.sums, parents[level], self.sums[level])
+            np.add.at(self.counts, parents[level], self.counts[level])
+
+        # Clusters of assemblies with more than one part, each with list of IDs in pre-order
+        # as identical sub-assemblies share cluster; of nodes with same parts (i.e. assemblies
+        # of single child), highest is kept
+        tin, tout, euler = tree.get_euler_index()
+        nodes = euler[euler >= 0]
+        nodes = nodes[(self.counts[nodes] > 1) &
+                      ((parents[nodes] < 0) | (self.counts[parents[nodes]] > self.counts[nodes]))]
+        self.clusters = {}
+        for id_, count, sum_1, sum_2 in zip(nodes.tolist(), self.counts[nodes].tolist(),
+                                            *self.sums[nodes].T.tolist()):
+            self.clusters.setdefault((count, sum_1, sum_2), []).append(id_)
+        self.n_clusters = len(nodes)
+
+
+
+    def get_cluster(self, id_):
+        # Signature of parts of node, comparable with those of other trees
+        return (int(self.counts[id_]), int(self.sums[id_, 0]), int(self.sums[id_, 1]))
+
+    def get_distance(self, other, normalise = False):
+        # Number of clusters in one structure but not other, as multisets, optionally as fraction
+        # of all clusters
+        shared   = sum(min(len(el), len(other.clusters[k])) for k, el in self.clusters.items() if k in other.clusters)
+        total    = self.n_clusters + other.n_clusters
+        distance = total - 2*shared
+        if normalise:
+            return distance/total if total else 0.0
+        return distance
+
+
+
+class AssemblyComparison:
+
+    def __init__(self, tree_1, tree_2, key = 'tag'):
+
+        # Compare two trees of same parts, matched by "key" (see "get_part_keys")
+        self.sig_1 = tree_1 if isinstance(tree_1, AssemblySignature) else AssemblySignature(tree_1, key)
+        self.sig_2 = tree_2 if isinstance(tree_2, AssemblySignature) else AssemblySignature(tree_2, key)
+        self.tree_1 = self.sig_1.tree
+        self.tree_2 = self.sig_2.tree
+
+        # Parts of both trees numbered as bits, those of first tree first
+        self.part_keys  = list(self.sig_1.part_keys)
+        self.part_index = {el: i for i, el in enumerate(self.part_keys)}
+        for el in self.sig_2.part_keys:
+            if el not in self.part_index:
+                self.part_index[el] = len(self.part_keys)
+                self.part_keys.append(el)
+        self.part_map = [dict(zip(sig.part_ids.tolist(), (self.part_index[el] for el in sig.part_keys)))
+                         for sig in (self.sig_1, self.sig_2)]
+        self.key_map  = [dict(zip(sig.part_ids.tolist(), sig.part_keys)) for sig in (self.sig_1, self.sig_2)]
+        self.id_map   = [dict(zip(sig.part_keys, sig.part_ids.tolist())) for sig in (self.sig_1, self.sig_2)]
+
+
+
+    def get_shared(self):
+        # Sub-assemblies with same parts in both trees, as list of (ID in first, ID in second)
+        clusters_2 = self.sig_2.clusters
+        return [pair for el, ids in self.sig_1.clusters.items() if el in clusters_2
+                for pair in zip(ids, clusters_2[el])]
+
+    def get_distance(self, normalise = False):
+        # Number of sub-assemblies in one tree but not other, see "AssemblySignature.get_distance"
+        return self.sig_1.get_distance(self.sig_2, normalise)
+
+
+
+    def get_bits(self, id_, tree = 0):
+        # Bitset of parts of node in first (0) or second (1) tree, in numbering of both
+        tree_ = (self.tree_1, self.tree_2)[tree]
+        part_map = self.part_map[tree]
+        bits = 0
+        for el in tree_.get_subtree_ids(id_):
+            i = part_map.get(el)
+            if i is not None:
+                bits |= 1 << i
+        return bits
+
+    def get_keys(self, bits):
+        # Keys of parts in bitset
+        keys = []
+        while bits:
+            low = bits & -bits
+            keys.append(self.part_keys[low.bit_length() - 1])
+            bits ^= low
+        return keys
+
+    def get_meet(self, id_1, id_2):
+        # Parts common to node "id_1" of first tree and "id_2" of second, as bitset
+        return self.get_bits(id_1, 0) & self.get_bits(id_2, 1)
+
+    def get_join(self, id_1, id_2):
+        # Parts of either of node "id_1" of first tree and "id_2" of second, as bitset
+        return self.get_bits(id_1, 0) | self.get_bits(id_2, 1)
+
+
+
+    def get_join_node(self, id_, tree = 0):
+
+        # Get ID of smallest node in other tree containing all parts of node "id_" in first (0)
+        # or second (1) tree, i.e. its join in other structure; None if no parts in other tree
+        key_map = self.key_map[tree]
+        id_map  = self.id_map[1 - tree]
+        ids = [id_map[key_map[el]] for el in (self.tree_1, self.tree_2)[tree].get_subtree_ids(id_)
+               if el in key_map and key_map[el] in id_map]
+        if not ids:
+            return None
+        return (self.tree_1, self.tree_2)[1 - tree].get_common_ancestor(ids)
+
+
+
+def rank_structures(reference, candidates, key = 'tag', normalise = True):
+
+    # Rank candidate trees by distance from reference tree, nearest first,
+    # as list of (distance, index of candidate); reference signature is computed once
+    reference = reference if isinstance(reference, AssemblySignature) else AssemblySignature(reference, key)
+    distances = []
+    for i, el in enumerate(candidates):
+        sig = el if isinstance(el, AssemblySignature) else AssemblySignature(el, key)
+        distances.append((reference.get_distance(sig, normalise), i))
+    return sorted(distances)
+
+
+
+### ---
+# Spatial index of lattice node positions
+# ---
+# Lattice nodes lie on few horizontal lines, y being lattice level (n_a), so nodes are held
+# sorted by (y, x) with start of each level, i.e. grid of levels each with sorted x;
+# nearest node and nodes in rectangle are then found by binary search
+# ---
+# Distances are scaled by x and y factors, e.g. pixels per unit of plot axes, so that
+# nearest node is that nearest on screen at any zoom
+### ---
+
+class LatticeIndex:
+
+    def __init__(self, ids, x, y):
+        order = np.lexsort((x, y))
+        self.ids = np.asarray(ids, dtype = np.int64)[order]
+        self.x   = np.asarray(x, dtype = float)[order]
+        self.y   = np.asarray(y, dtype = float)[order]
+        self.get_levels()
+
+    def __len__(self):
+        return len(self.ids)
+
+    def get_levels(self):
+        # Distinct y values, and start of each in sorted arrays, with end as last entry
+        starts = np.flatnonzero(np.diff(self.y)) + 1
+        self.starts = np.concatenate(([0], starts, [len(self.y)])) if len(self.y) else np.zeros(1, dtype = np.int64)
+        self.levels = self.y[self.starts[:-1]]
+
+
+
+    def update(self, ids, x, y, removed_ids = ()):
+
+        # Move nodes with given IDs to new positions (adding any not present) and drop removed nodes
+        ids  = np.asarray(ids, dtype = np.int64)
+        drop = np.isin(self.ids, np.concatenate((ids, np.asarray(list(removed_ids), dtype = np.int64))))
+        if drop.any():
+            keep = ~drop
+            self.ids, self.x, self.y = self.ids[keep], self.x[keep], self.y[keep]
+            self.get_levels()
+        if not len(ids):
+            return
+        order = np.lexsort((x, y))
+        ids, x, y = ids[order], np.asarray(x, dtype = float)[order], np.asarray(y, dtype = float)[order]
+        # Insertion points in existing arrays, within level then by x
+        points = []
+        for x_, y_ in zip(x.tolist(), y.tolist()):
+            lo = np.searchsorted(self.y, y_, 'left')
+            hi = np.searchsorted(self.y, y_, 'right')
+            points.append(lo + np.searchsorted(self.x[lo:hi], x_))
+        self.ids = np.insert(self.ids, points, ids)
+        self.x   = np.insert(self.x, points, x)
+        self.y   = np.insert(self.y, points, y)
+        self.get_levels()
+
+
+
+    def get_nearest(self, x, y, scale = (1, 1)):
+
+        # Get (ID, distance) of node nearest to (x, y), distance being scaled by "scale"
+        # Levels are searched outwards from y, until vertical distance alone exceeds best found
+        if not len(self.ids):
+            return None, None
+        sx, sy = scale
+        best, best_id = float('inf'), None
+        above = np.searchsorted(self.levels, y)
+        below = above - 1
+        while below >= 0 or above < len(self.levels):
+            dy_below = (y - self.levels[below])*sy if below >= 0 else float('inf')
+            dy_above = (self.levels[above] - y)*sy if above < len(self.levels) else float('inf')
+            if min(dy_below, dy_above) >= best:
+                break
+            if dy_below <= dy_above:
+                i, dy = below, dy_below
+                below -= 1
+            else:
+                i, dy = above, dy_above
+                above += 1
+            # Nearest in x within level, either side of insertion point
+            lo, hi = self.starts[i], self.starts[i + 1]
+            j = lo + np.searchsorted(self.x[lo:hi], x)
+            for k in (j - 1, j):
+                if lo <= k < hi:
+                    d = np.hypot((self.x[k] - x)*sx, dy)
+                    if d < best:
+                        best, best_id = d, int(self.ids[k])
+        return best_id, best
+
+
+
+    def get_in_rect(self, x_0, y_0, x_1, y_1):
+
+        # Get array of IDs of nodes within rectangle, corners in any order
+        x_0, x_1 = min(x_0, x_1), max(x_0, x_1)
+        y_0, y_1 = min(y_0, y_1), max(y_0, y_1)
+        first = np.searchsorted(self.levels, y_0, 'left')
+        last  = np.searchsorted(self.levels, y_1, 'right')
+        found = []
+        for i in range(first, last):
+            lo, hi = self.starts[i], self.starts[i + 1]
+            found.append(self.ids[lo + np.searchsorted(self.x[lo:hi], x_0, 'left'):
+                                  lo + np.searchsorted(self.x[lo:hi], x_1, 'right')])
+        return np.concatenate(found) if found else self.ids[:0]
+
+
+
+### ---
+# Edge crossings of lattice
+# ---
+# Straight edges are split at every lattice level they pass, so each piece spans one band
+# between adjacent levels; two pieces in same band cross if their order at bottom and at top
+# differ, so with pieces sorted by band then x at bottom, crossings are inversions of x at top
+### ---
+
+def count_inversions(values):
+
+    # Number of pairs of integer values out of order, i.e. i < j and values[i] > values[j]
+    # ---
+    # Bottom-up merge sort: at each pass, larger values in sorted left half of each block are
+    # counted for every value in right half; blocks are kept apart by offsetting values by
+    # block number, so all blocks are searched and sorted at once
+    values = np.asarray(values, dtype = np.int64)
+    if len(values) < 2:
+        return 0
+    values = values - values.min()
+    bound  = int(values.max()) + 1
+    index  = np.arange(len(values))
+    count  = 0
+    width  = 1
+    while width < len(values):
+        blocks = index//(2*width)
+        right  = index % (2*width) >= width
+        keyed  = values + blocks*bound
+        ends   = np.cumsum(np.bincount(blocks[~right], minlength = blocks[-1] + 1))
+        count += int((ends[blocks[right]] - np.searchsorted(keyed[~right], keyed[right], 'right')).sum())
+        values = np.sort(keyed) - blocks*bound
+        width *= 2
+    return count
+
+
+
+class StepParse:
+
+    # Attributes set by "load_step", i.e. entities and resolved product structure, see "take_step"
+    step_attributes = ('filename', 'step_filename', 'buffer', 'entities', 'fingerprints',
+                       'nauo_lines', 'prod_def_lines', 'prod_def_form_lines', 'prod_lines',
+                       'nauo_refs', 'prod_def_refs', 'prod_def_form_refs', 'prod_refs',
+                       'prod_all_refs', 'dangling_refs', 'part_dict', 'dag',
+                       'parent_refs', 'child_refs', 'all_type_refs', 'ass_type_refs', 'part_type_refs',
+                       'root_type_refs')
+
+    def __init__(self):
+
+        # Memory-mapped STEP file, if loaded with "use_mmap", and names of parts,
+        # some possibly held as offsets in it (see "StepNames") until file closed
+        self.buffer    = None
+        self.part_dict = None
+
+        # Product structure as DAG, see "get_dag"
+        self.dag        = None
+        self.unexpanded = set()
+
+        # Next node ID to try, see "get_new_id"; None until first needed for tree
+        self._next_id = None
+
+        # If set, trees with more nodes than this are created only to depth at which
+        # size is not exceeded; deeper occurrences are expanded on demand
+        self.max_tree_size = None
+
+        # Arrays for level-of-detail view of lattice, see "get_lattice_detail"
+        self.detail_arrays = None
+
+        # Lattice layout, see "set_lattice_positions": "mean" or, if SciPy available,
+        # layered with crossing reduction by "barycentre" or "median" of neighbours;
+        # crossings are counted on edges split at lattice levels, so layered layout falls back
+        # to "mean" if there are more than "layout_max_pieces" pieces, e.g. for deep chains
+        self.layout            = 'mean'
+        self.layout_sweeps     = 4
+        self.layout_max_pieces = 1 << 20
 
-# Import "anytree" as well as "treelib" as better rendering capabilities
-#from anytree import AnyNode, Node, RenderTree
+    def load_step(self, step_filename, use_mmap = False, workers = None, progress = None):
 
-#TH: useful for working with files
-import os
+        # Load product structure from STEP file
+        # ---
+        # If "use_mmap", file is memory-mapped and scanned in bounded chunks, raw entity lines
+        # are not kept and product names are decoded from file only when looked up in "part_dict";
+        # mapped file is held open in "buffer" until "close" is called
+        # ---
+        # If "workers" > 1, DATA section is parsed in parallel in that many processes
+        # ---
+        # Compressed files (gzip, zip or STEP-Z) are decompressed as a stream, in which case
+        # "use_mmap" and "workers" are ignored and offsets are those in decompressed data
+        # ---
+        # "progress" is passed to "iter_entities" (or "parse_parallel"), so reports offsets
+        # in (possibly decompressed) data and number of entities found, and can cancel loading
+        self.filename      = get_step_basename(step_filename)
+        self.step_filename = step_filename
+        self.close()
+
+        if is_compressed(step_filename):
+            if use_mmap or (workers and workers > 1):
+                print('Compressed STEP file: parsing as single stream')
+            with open_step(step_filename) as f:
+                table = collect_entities(iter_entities(f, types = STEP_TYPES, progress = progress))
+            self.set_entities(*table)
+            return
 
-import sys
+        if workers and workers > 1:
+            table = parse_parallel(step_filename, workers, keep_lines = not use_mmap, progress = progress)
+            if use_mmap and os.path.getsize(step_filename):
+                with open(step_filename, 'rb') as f:
+                    self.buffer = mmap.mmap(f.fileno(), 0, access = mmap.ACCESS_READ)
+            self.set_entities(*table)
+            return
 
-#TH: for exporting to json format
-import json
+        # Single pass through DATA section, split at ";" terminators rather than newlines
+        with open(step_filename, 'rb') as f:
+            if use_mmap and os.fstat(f.fileno()).st_size:
+                self.buffer = mmap.mmap(f.fileno(), 0, access = mmap.ACCESS_READ)
+                # Mapped file released if parsing fails or is cancelled
+                try:
+                    table = collect_entities(iter_entities(self.buffer, types = STEP_TYPES, progress = progress),
+                                             keep_lines = False)
+                except BaseException:
+                    self.close()
+                    raise
+            else:
+                table = collect_entities(iter_entities(f, types = STEP_TYPES, progress = progress))
 
-# HR Oct 19
-# Allow stdout to be captured for later use
-from io import StringIO
+        self.set_entities(*table)
 
 
 
-class Capture(list):
+    def set_entities(self, entities, refs_dict, lines_dict, fingerprints):
 
-    # Class for capturing stdout
-    def __enter__(self):
-        self._stdout = sys.stdout
-        sys.stdout = self._stringio = StringIO()
-        return self
+        # Entity table of all product-structure entities found: "#id" -> (type, args start, args end),
+        # where start and end are byte offsets of the raw argument list in the file
+        self.entities     = entities
+        self.fingerprints = fingerprints
 
-    def __exit__(self, *args):
-        self.extend(self._stringio.getvalue().splitlines())
-        del self._stringio
-        sys.stdout = self._stdout
+        self.nauo_lines          = lines_dict['nauo']
+        self.prod_def_lines      = lines_dict['prod_def']
+        self.prod_def_form_lines = lines_dict['prod_def_form']
+        self.prod_lines          = lines_dict['prod']
 
+        self.nauo_refs           = refs_dict['nauo']
+        self.prod_def_refs       = refs_dict['prod_def']
+        self.prod_def_form_refs  = refs_dict['prod_def_form']
+        self.prod_refs           = refs_dict['prod']
 
+        self.resolve_products()
 
-class StepParse:
 
-    def __init__(self):
-        pass
 
-    def load_step(self,step_filename):
+    def close(self):
 
-        self.nauo_lines          = []
-        self.prod_def_lines      = []
-        self.prod_def_form_lines = []
-        self.prod_lines          = []
-        self.filename = os.path.splitext(step_filename)[0]
-
-
-
-        line_hold = ''
-        line_type = ''
-
-        # Find all search lines
-        with open(step_filename) as f:
-            for line in f:
-                # TH: read pointer of lines as they are read, so if the file has text wrap it will notice and add it to the following lines
-                index = re.search("#(.*)=", line)
-                if index:
-                    # TH: if not none then it is the start of a line so read it
-                    # want to hold line until it has checked next line
-                    # if next line is a new indexed line then save previous line
-                    if line_hold:
-                        if line_type == 'nauo':
-                            self.nauo_lines.append(line_hold)
-                        elif line_type == 'prod_def':
-                            self.prod_def_lines.append(line_hold)
-                        elif line_type == 'prod_def_form':
-                            self.prod_def_form_lines.append(line_hold)
-                        elif line_type == 'prod':
-                            self.prod_lines.append(line_hold)
-                        line_hold = ''
-                        line_type = ''
-
-
-
-                    prev_index = True  # TH remember previous line had an index
-                    if 'NEXT_ASSEMBLY_USAGE_OCCURRENCE' in line:
-                        line_hold = line.rstrip()
-                        line_type = 'nauo'
-                    elif ('PRODUCT_DEFINITION ' in line or 'PRODUCT_DEFINITION(' in line):
-                        line_hold = line.rstrip()
-                        line_type = 'prod_def'
-                    elif 'PRODUCT_DEFINITION_FORMATION' in line:
-                        line_hold = line.rstrip()
-                        line_type = 'prod_def_form'
-                    elif ('PRODUCT ' in line or 'PRODUCT(' in line):
-                        line_hold = line.rstrip()
-                        line_type = 'prod'
-                else:
-                    prev_index = False
-                    #TH: if end of file and previous line was held
-                    if 'ENDSEC;' in line:
-                        if line_hold:
-                            if line_type == 'nauo':
-                                self.nauo_lines.append(line_hold)
-                            elif line_type == 'prod_def':
-                                self.prod_def_lines.append(line_hold)
-                            elif line_type == 'prod_def_form':
-                                self.prod_def_form_lines.append(line_hold)
-                            elif line_type == 'prod':
-                                self.prod_lines.append(line_hold)
-                            line_hold = ''
-                            line_type = ''
-                    else:
-                        #TH: if not end of file
-                        line_hold = line_hold + line.rstrip()
-
-
-
-        self.nauo_refs          = []
-        self.prod_def_refs      = []
-        self.prod_def_form_refs = []
-        self.prod_refs          = []
-
-        # TH: added 'replace(","," ").' to replace ',' with a space to make the spilt easier if there are not spaces inbetween the words'
-        # Find all (# hashed) line references and product names
-        # TH: it might be worth finding a different way of extracting data we do want rather than fixes to get rid of the data we don't
-        for j,el_ in enumerate(self.nauo_lines):
-            self.nauo_refs.append([el.rstrip(',')          for el in el_.replace(","," ").replace("="," ").split()                  if el.startswith('#')])
-        for j,el_ in enumerate(self.prod_def_lines):
-            self.prod_def_refs.append([el.rstrip(',')      for el in el_.replace(","," ").replace("="," ").split()                  if el.startswith('#')])
-        for j,el_ in enumerate(self.prod_def_form_lines):
-            self.prod_def_form_refs.append([el.rstrip(',') for el in el_.replace(","," ").replace("="," ").split()                  if el.startswith('#')])
-        for j,el_ in enumerate(self.prod_lines):
-            self.prod_refs.append([el.strip(',')           for el in el_.replace(","," ").replace("("," ").replace("="," ").split() if el.startswith('#')])
-            self.prod_refs[j].append(el_.split("'")[1])
+        # Release memory-mapped STEP file, if any
+        if self.buffer is not None:
+            # Names not yet looked up must be decoded before file is unmapped
+            if isinstance(self.part_dict, StepNames):
+                self.part_dict = dict(self.part_dict)
+            self.buffer.close()
+        self.buffer = None
+
+
+
+    def resolve_products(self):
+
+        # Match up all references down to level of product name via dictionary joins:
+        # 'PRODUCT_DEFINITION' -> 'PRODUCT_DEFINITION_FORMATION <etc>' -> 'PRODUCT' -> name
+        # ---
+        # Dangling references (i.e. to entities not in file) are recorded in "dangling_refs"
+        # as (referring entity ref, missing ref) and reported; name then defaults to ref
+        form_dict = {el[0]:el[1] for el in self.prod_def_form_refs if len(el) > 1}
+        name_dict = {el[0]:el[-1] for el in self.prod_refs}
+        self.dangling_refs = []
 
         # Get first two items in each sublist (as third is shape ref)
         #
         # First item is 'PRODUCT_DEFINITION' ref
         # Second item is 'PRODUCT_DEFINITION_FORMATION <etc>' ref
-        self.prod_all_refs = [el[:2] for el in self.prod_def_refs]
+        # Then 'PRODUCT' ref and product name are added
+        self.prod_all_refs = []
+        for el in self.prod_def_refs:
+            prod_def_ref  = el[0]
+            prod_form_ref = el[1] if len(el) > 1 else None
+            prod_ref      = form_dict.get(prod_form_ref)
+            name          = name_dict.get(prod_ref)
+            if prod_ref is None:
+                self.dangling_refs.append((prod_def_ref, prod_form_ref))
+            elif name is None:
+                self.dangling_refs.append((prod_form_ref, prod_ref))
+            if name is None:
+                name = prod_def_ref
+            self.prod_all_refs.append([prod_def_ref, prod_form_ref, prod_ref, name])
+
+        self.get_type_refs()
+        self.dag = None
+
+        # Create simple parts dictionary (ref + label)
+        self.part_dict     = {el[0]:el[3] for el in self.prod_all_refs}
+        if self.buffer is not None:
+            self.part_dict = StepNames(self.buffer, self.part_dict)
+#        self.part_dict_inv = {el[3]:el[0] for el in self.prod_all_refs}
 
-        # Match up all references down to level of product name
-        for j,el_ in enumerate(self.prod_all_refs):
+        # Occurrences of product definitions not in file
+        for el in self.nauo_refs:
+            for ref in el[1:3]:
+                if ref not in self.part_dict:
+                    self.dangling_refs.append((el[0], ref))
+                    self.part_dict[ref] = ref
 
-            # Add 'PRODUCT_DEFINITION' ref
-            for i,el in enumerate(self.prod_def_form_refs):
-                if el[0] == el_[1]:
-                    el_.append(el[1])
-                    break
+        if self.dangling_refs:
+            print('Warning: %i dangling reference(s) in STEP file, e.g. %s -> %s' %
+                  (len(self.dangling_refs), *self.dangling_refs[0]))
 
-            # Add names from 'PRODUCT_DEFINITION' lines
-            for i,el in enumerate(self.prod_refs):
-                if el[0] == el_[2]:
-                    el_.append(el[2])
-                    break
 
 
+    def get_type_refs(self):
 
         # Find all parent and child relationships (3rd and 2nd item in each sublist)
         self.parent_refs = [el[1] for el in self.nauo_refs]
@@ -195,9 +2018,524 @@ class StepParse:
         #TH: find root node
         self.root_type_refs = set(self.parent_refs) - set(self.child_refs)
 
-        # Create simple parts dictionary (ref + label)
-        self.part_dict     = {el[0]:el[3] for el in self.prod_all_refs}
-#        self.part_dict_inv = {el[3]:el[0] for el in self.prod_all_refs}
+
+
+    def load(self, step_filename, cache = None, cancel = None, **kwargs):
+
+        # Load STEP file and create tree, levels and lattice
+        # ---
+        # If "cache" (a "StepCache") given and file has been loaded before, parsing and creation
+        # of tree and levels is skipped; otherwise results are added to cache
+        # Cached trees are only used for same "max_tree_size", as partly created otherwise
+        # If "cancel" (e.g. "threading.Event") is set once file parsed, "LoadCancelled" is raised
+        # before tree is created; other kwargs are passed to "load_step"
+        if cache is not None:
+            data = cache.get(step_filename, self.max_tree_size)
+            if data is not None:
+                self.from_cache(step_filename, data)
+                return
+
+        self.load_step(step_filename, **kwargs)
+        if cancel is not None and cancel.is_set():
+            self.close()
+            raise LoadCancelled()
+        self.create_tree()
+
+        if cache is not None and self.tree.size():
+            cache.put(step_filename, self.to_cache(), self.max_tree_size)
+
+
+
+    def to_cache(self):
+
+        # Get resolved product structure, tree and levels as plain data for caching
+        tree_nodes = [(k, v.tag, self.tree.parent(k).identifier if k != self.tree.root else None, v.data)
+                      for k, v in self.tree.nodes.items()]
+        return {'nauo_refs':       self.nauo_refs,
+                'part_dict':       dict(self.part_dict),
+                'dangling_refs':   self.dangling_refs,
+                'fingerprints':    self.fingerprints,
+                'tree_nodes':      tree_nodes,
+                'tree_dict':       self.tree_dict,
+                'node_nauo':       self.node_nauo,
+                'unexpanded':      self.unexpanded,
+                'tree_max_depth':  self.tree_max_depth,
+                'levels':          self.levels,
+                'levels_set_p':    self.levels_set_p,
+                'levels_set_a':    self.levels_set_a,
+                'levels_p_sorted': self.levels_p_sorted,
+                'levels_a_sorted': self.levels_a_sorted,
+                'levels_p_inv':    self.levels_p_inv,
+                'levels_a_inv':    self.levels_a_inv}
+
+
+
+    def from_cache(self, step_filename, data):
+
+        # Restore state from "to_cache" data, then create lattice
+        self.filename      = get_step_basename(step_filename)
+        self.step_filename = step_filename
+        self.close()
+
+        # Raw entities are not cached
+        self.entities            = {}
+        self.nauo_lines          = []
+        self.prod_def_lines      = []
+        self.prod_def_form_lines = []
+        self.prod_lines          = []
+        self.prod_def_refs       = []
+        self.prod_def_form_refs  = []
+        self.prod_refs           = []
+        self.prod_all_refs       = []
+
+        self.nauo_refs     = data['nauo_refs']
+        self.part_dict     = data['part_dict']
+        self.dangling_refs = data['dangling_refs']
+        self.fingerprints  = data['fingerprints']
+        self.get_type_refs()
+        self.dag = None
+
+        # Nodes are in creation order, so parents always precede children
+        self.tree = AssemblyTree()
+        for id_, tag, parent, node_data in data['tree_nodes']:
+            self.tree.create_node(tag, id_, parent = parent, data = node_data)
+        self.tree_dict = data['tree_dict']
+        self._next_id  = None
+        self.node_nauo = data['node_nauo']
+        self.unexpanded     = data['unexpanded']
+        self.tree_max_depth = data['tree_max_depth']
+        self.appended  = False
+
+        self.levels          = data['levels']
+        self.levels_set_p    = data['levels_set_p']
+        self.levels_set_a    = data['levels_set_a']
+        self.levels_p_sorted = data['levels_p_sorted']
+        self.levels_a_sorted = data['levels_a_sorted']
+        self.levels_p_inv    = data['levels_p_inv']
+        self.levels_a_inv    = data['levels_a_inv']
+        self.all_ids         = set(self.tree.get_ids().tolist())
+        self.leaf_ids        = set(self.tree.get_leaf_ids().tolist()) - self.unexpanded
+        self.non_leaf_ids    = self.all_ids - self.leaf_ids
+        self.part_level      = 1
+        self.set_level_arrays()
+        self.count_levels()
+        self.tree.track_changes()
+
+        self.create_lattice()
+
+
+
+    def reload_step(self, step_filename = None, loaded = None, **kwargs):
+
+        # Reload STEP file (by default, that loaded previously) after it has changed,
+        # patching tree, levels and lattice only where product-structure entities differ
+        # ---
+        # Entities are compared via fingerprints from previous load; returns dictionary of
+        # lists of "added", "removed" and "changed" entity refs, also kept as "last_diff"
+        # Tree is recreated in full if no tree, root has changed or most NAUOs differ
+        # If "loaded" given, file has already been loaded by its "load_step" (e.g. in worker thread),
+        # see "take_step"; otherwise other kwargs are passed to "load_step"
+        old_fingerprints = self.fingerprints
+        old_nauo_refs    = {el[0]:el for el in self.nauo_refs}
+        old_part_dict    = dict(self.part_dict)
+        old_root_refs    = self.root_type_refs
+        old_dag_levels   = {self.tree_dict[el]:self.get_dag_levels(self.tree_dict[el]) for el in self.unexpanded}
+
+        if loaded is None:
+            self.load_step(step_filename or self.step_filename, **kwargs)
+        else:
+            self.take_step(loaded)
+
+        diff = {'added':   [el for el in self.fingerprints if el not in old_fingerprints],
+                'removed': [el for el in old_fingerprints if el not in self.fingerprints],
+                'changed': [el for el in self.fingerprints if el in old_fingerprints
+                            and self.fingerprints[el] != old_fingerprints[el]]}
+        self.last_diff = diff
+
+        new_nauo_refs = {el[0]:el for el in self.nauo_refs}
+        nauo_removed  = [el for el in old_nauo_refs if el not in new_nauo_refs or new_nauo_refs[el] != old_nauo_refs[el]]
+        nauo_added    = [el for el in new_nauo_refs if el not in old_nauo_refs or new_nauo_refs[el] != old_nauo_refs[el]]
+
+        if (not hasattr(self, 'tree') or not self.tree.size() or self.root_type_refs != old_root_refs
+                or len(nauo_removed) + len(nauo_added) > len(new_nauo_refs)):
+            self.create_tree(self.tree_max_depth)
+            return diff
+
+        changed_ids = set()
+
+        # Remove nodes (with subtrees) of removed/changed NAUOs
+        removed_nauos = set(nauo_removed)
+        for id_, nauo in list(self.node_nauo.items()):
+            if nauo in removed_nauos and id_ in self.tree:
+                changed_ids.add(self.tree.parent(id_).identifier)
+                self.tree.remove_node(id_)
+        for id_ in [el for el in self.tree_dict if el not in self.tree]:
+            self.tree_dict.pop(id_)
+            self.node_nauo.pop(id_, None)
+            self.unexpanded.discard(id_)
+        changed_ids &= set(self.tree.nodes)
+
+        # Add subtrees for added/changed NAUOs to all existing (expanded) occurrences of their parent
+        ref_nodes = {}
+        for id_, ref in self.tree_dict.items():
+            if id_ not in self.unexpanded:
+                ref_nodes.setdefault(ref, []).append(id_)
+        for nauo in nauo_added:
+            nauo_line = new_nauo_refs[nauo]
+            for parent in ref_nodes.get(nauo_line[1], []):
+                changed_ids.add(parent)
+                changed_ids.update(self.add_subtree(parent, nauo_line, self.tree_max_depth))
+
+        # Unexpanded nodes stand in for substructures that may have changed
+        for id_ in self.unexpanded:
+            ref = self.tree_dict[id_]
+            if old_dag_levels.get(ref) != self.get_dag_levels(ref):
+                changed_ids.add(id_)
+
+        # Update labels of nodes whose product names have changed
+        for id_, ref in self.tree_dict.items():
+            if old_part_dict.get(ref) != self.part_dict[ref]:
+                self.tree.update_node(id_, tag = self.part_dict[ref])
+
+        self.update_edits(changed_ids)
+        return diff
+
+
+
+    def take_step(self, other):
+
+        # Take STEP file loaded by "load_step" of other parser, e.g. in worker thread so this one
+        # is unchanged until then, as if loaded by own "load_step"; other is not to be used after
+        self.close()
+        for el in self.step_attributes:
+            setattr(self, el, getattr(other, el))
+        other.buffer = None
+
+
+
+    def get_children_dict(self):
+
+        # Parent ref -> list of NAUO lines of its children, in file order
+        children_dict = {}
+        for el in self.nauo_refs:
+            children_dict.setdefault(el[1], []).append(el)
+        return children_dict
+
+
+
+    def get_dag(self):
+
+        # Get product structure as directed acyclic graph, i.e. "get_children_dict",
+        # created on first call after loading
+        # ---
+        # Each product definition's substructure is held once however many times it occurs,
+        # so levels of sub-assemblies are computed once (see "get_dag_levels") and tree nodes
+        # need only be created for occurrences that are expanded (see "expand_node")
+        if self.dag is None:
+            self.dag        = self.get_children_dict()
+            self.dag_levels = {}
+        return self.dag
+
+
+
+    def get_dag_levels(self, ref):
+
+        # Get (n_p, n_a) of full substructure of product definition,
+        # via iterative post-order traversal of DAG, memoised
+        dag   = self.get_dag()
+        stack = [ref]
+        while stack:
+            el = stack[-1]
+            if el in self.dag_levels:
+                stack.pop()
+                continue
+            children = [line[2] for line in dag.get(el, [])]
+            pending  = [child for child in children if child not in self.dag_levels]
+            if pending:
+                stack.extend(pending)
+                continue
+            stack.pop()
+            if children:
+                n_p = sum(self.dag_levels[child][0] for child in children)
+                n_a = sum(self.dag_levels[child][1] for child in children) + 1
+            else:
+                n_p = n_a = self.part_level
+            self.dag_levels[el] = (n_p, n_a)
+        return self.dag_levels[ref]
+
+
+
+    def get_tree_depth(self, ref, max_size):
+
+        # Get greatest depth to which tree of product definition can be created without
+        # exceeding "max_size" nodes (at least 1), from numbers of occurrences per depth in DAG
+        dag   = self.get_dag()
+        layer = {ref: 1}
+        size  = 1
+        depth = 0
+        while layer:
+            next_layer = {}
+            for el, n in layer.items():
+                for line in dag.get(el, []):
+                    next_layer[line[2]] = next_layer.get(line[2], 0) + n
+            size += sum(next_layer.values())
+            if size > max_size:
+                break
+            depth += 1
+            layer = next_layer
+        return max(depth, 1)
+
+
+
+    def get_name(self, ref):
+
+        # Get product name of product definition
+        return self.part_dict[ref]
+
+
+
+    def add_subtree(self, parent, line, depth = None):
+
+        # Add node for NAUO "line" under "parent" and nodes for its substructure, down to
+        # "depth" levels in all (all if None); deeper assemblies are left unexpanded
+        # Nodes are created depth-first, in file order; returns list of IDs of added nodes
+        dag    = self.get_dag()
+        added  = []
+        stack  = [(parent, line, depth)]
+        while stack:
+            parent_, line_, depth_ = stack.pop()
+            new_id = self.get_new_id()
+            self.tree_dict[new_id] = line_[2]
+            self.node_nauo[new_id] = line_[0]
+            # HR added part reference as data for later use
+            self.tree.create_node(self.get_name(line_[2]), new_id, parent = parent_, data = {'ref': line_[2]})
+            added.append(new_id)
+            children = dag.get(line_[2], [])
+            if not children:
+                continue
+            if depth_ is None or depth_ > 1:
+                stack.extend((new_id, el, depth_ and depth_ - 1) for el in reversed(children))
+            else:
+                self.unexpanded.add(new_id)
+        return added
+
+
+
+    def get_new_id(self):
+
+        # Get ID for new node, not in tree or "tree_dict"; largest ID is found once per tree,
+        # then IDs are counted up from it, skipping any taken since by nodes created elsewhere
+        if self._next_id is None:
+            ids = self.tree.get_ids()
+            self._next_id = max(max(self.tree_dict, default = -1), int(ids[-1]) if len(ids) else -1) + 1
+        while self._next_id in self.tree_dict or self._next_id in self.tree:
+            self._next_id += 1
+        self._next_id += 1
+        return self._next_id - 1
+
+
+
+    def expand_node(self, id_, depth = 1):
+
+        # Add children of unexpanded node to tree, down to "depth" levels below it (all if None)
+        # Returns list of IDs of added nodes; levels/lattice must be updated afterwards
+        if id_ not in self.unexpanded or id_ not in self.tree or (depth is not None and depth <= 0):
+            return []
+        self.unexpanded.discard(id_)
+        added = []
+        for line in self.get_dag().get(self.tree_dict[id_], []):
+            added.extend(self.add_subtree(id_, line, depth))
+        return added
+
+
+
+    def update_edits(self, changed_ids = ()):
+
+        # Update levels and lattice incrementally after tree edited, e.g. in GUI, from changes
+        # recorded by tree since levels last updated; "changed_ids" are any other nodes whose
+        # levels may have changed, e.g. unexpanded nodes whose substructure has changed
+        changed, removed, relabelled = self.tree.pop_changes()
+        affected = self.update_levels(changed | set(changed_ids), removed)
+        self.update_lattice(affected, removed, relabelled)
+
+
+
+    def update_levels(self, changed_ids, removed_ids = None):
+
+        # Update levels after tree modified, given IDs of nodes added, moved or whose children have changed,
+        # and of nodes removed (found by search if None); only those nodes and their ancestors are recomputed,
+        # deepest first, and only their entries in level counts, inverse dictionaries and
+        # leaf/non-leaf sets changed, so work done is independent of size of tree
+        # Returns set of IDs of recomputed nodes
+        size = len(self.tree.get_parents())
+        if len(self.n_p) < size:
+            self.n_p = np.concatenate((self.n_p, np.zeros(size - len(self.n_p), dtype = np.int64)))
+            self.n_a = np.concatenate((self.n_a, np.zeros(size - len(self.n_a), dtype = np.int64)))
+
+        # IDs to be removed from and added to each set in inverse dictionaries, done together at end
+        dropped = {'n_p': {}, 'n_a': {}}
+        added   = {'n_p': {}, 'n_a': {}}
+
+        def count(n_p, n_a, step):
+            if n_a != self.part_level:
+                self.levels_count_p[n_p] = self.levels_count_p.get(n_p, 0) + step
+                self.levels_count_a[n_a] = self.levels_count_a.get(n_a, 0) + step
+
+        def discard(id_):
+            old = self.levels.pop(id_)
+            count(old['n_p'], old['n_a'], -1)
+            dropped['n_p'].setdefault(old['n_p'], set()).add(id_)
+            dropped['n_a'].setdefault(old['n_a'], set()).add(id_)
+
+        if removed_ids is None:
+            removed_ids = [el for el in self.levels if el not in self.tree]
+        for id_ in removed_ids:
+            if id_ in self.levels:
+                discard(id_)
+            if id_ not in self.tree:
+                self.n_p[id_] = self.n_a[id_] = 0
+                self.unexpanded.discard(id_)
+                self.all_ids.discard(id_)
+                self.leaf_ids.discard(id_)
+                self.non_leaf_ids.discard(id_)
+
+        parents  = self.tree.get_parents()
+        affected = set()
+        for id_ in changed_ids:
+            while id_ >= 0 and id_ in self.tree and id_ not in affected:
+                affected.add(id_)
+                id_ = int(parents[id_])
+
+        # Depths of affected nodes, from those of parents, as all ancestors are affected too
+        depths = {}
+        for id_ in affected:
+            chain = []
+            while id_ not in depths and parents[id_] >= 0:
+                chain.append(id_)
+                id_ = int(parents[id_])
+            depth = depths.setdefault(id_, 0)
+            for el in reversed(chain):
+                depth += 1
+                depths[el] = depth
+
+        for id_ in sorted(affected, key = depths.get, reverse = True):
+            # Unexpanded nodes count their substructure plus any children added since
+            child_ids = self.tree.get_child_ids(id_)
+            self.all_ids.add(id_)
+            if len(child_ids) or id_ in self.unexpanded:
+                self.leaf_ids.discard(id_)
+                self.non_leaf_ids.add(id_)
+            else:
+                self.non_leaf_ids.discard(id_)
+                self.leaf_ids.add(id_)
+            if id_ in self.unexpanded:
+                n_p, n_a = self.get_leaf_levels(id_)
+                n_p += int(self.n_p[child_ids].sum())
+                n_a += int(self.n_a[child_ids].sum())
+            elif len(child_ids):
+                n_p = int(self.n_p[child_ids].sum())
+                n_a = int(self.n_a[child_ids].sum()) + 1
+            else:
+                n_p, n_a = self.get_leaf_levels(id_)
+            if id_ in self.levels:
+                if self.levels[id_] == {'n_p': n_p, 'n_a': n_a}:
+                    continue
+                discard(id_)
+            self.levels[id_] = {'n_p': n_p, 'n_a': n_a}
+            self.n_p[id_] = n_p
+            self.n_a[id_] = n_a
+            count(n_p, n_a, 1)
+            added['n_p'].setdefault(n_p, set()).add(id_)
+            added['n_a'].setdefault(n_a, set()).add(id_)
+
+        # Level sets from counts, then remove IDs from inverse dictionaries and empty levels
+        self.levels_count_p = {k:v for k,v in self.levels_count_p.items() if v > 0}
+        self.levels_count_a = {k:v for k,v in self.levels_count_a.items() if v > 0}
+        self.levels_set_p    = set(self.levels_count_p)
+        self.levels_set_a    = set(self.levels_count_a)
+        self.levels_p_sorted = sorted(self.levels_set_p)
+        self.levels_a_sorted = sorted(self.levels_set_a)
+        for levels_inv, key, levels_set in ((self.levels_p_inv, 'n_p', self.levels_set_p),
+                                            (self.levels_a_inv, 'n_a', self.levels_set_a)):
+            for value, ids in dropped[key].items():
+                if value in levels_inv:
+                    levels_inv[value] -= ids
+            for value, ids in added[key].items():
+                levels_inv.setdefault(value, set()).update(ids)
+            for value in [k for k,v in levels_inv.items() if not v and k != self.part_level and k not in levels_set]:
+                levels_inv.pop(value)
+
+        return affected
+
+
+
+    def update_lattice(self, changed_ids, removed_ids = (), relabelled = ()):
+
+        # Update lattice graph after tree modified, given IDs of nodes removed and of nodes added or
+        # whose levels or children may have changed (e.g. as returned by "update_levels");
+        # only nodes and edges of those are changed
+        # ---
+        # Positions of changed nodes are set as in "set_lattice_positions", from their children,
+        # new leaves being placed among their siblings; other positions are kept, so layout may
+        # differ from that of "create_lattice" until it is next called
+        for id_ in removed_ids:
+            if id_ in self.g:
+                self.g.remove_node(id_)
+        # Nodes first, then edges, as parents may also be new
+        new_edges = []
+        for id_ in changed_ids:
+            parent = self.tree.parent(id_)
+            parent_id = parent.identifier if parent else -1
+            if id_ not in self.g:
+                self.g.add_node(id_, parent = parent_id, label = self.tree.get_node(id_).tag, colour = self.default_colour)
+            elif self.g.nodes[id_]['parent'] != parent_id:
+                old_parent = self.g.nodes[id_]['parent']
+                if self.g.has_edge(id_, old_parent):
+                    self.g.remove_edge(id_, old_parent)
+                self.g.nodes[id_]['parent'] = parent_id
+            if parent:
+                new_edges.append((id_, parent_id))
+        self.g.add_edges_from(new_edges)
+        for id_ in relabelled:
+            if id_ in self.g:
+                self.g.nodes[id_]['label'] = self.tree.get_node(id_).tag
+
+        if self.tree.size() == 1:
+            self.g.nodes[self.tree.root]['pos'] = (0,0)
+            self.lattice_index = LatticeIndex([self.tree.root], [0], [0])
+            return
+
+        # Leaves first, then assemblies upwards, so children are positioned before parents
+        branches = []
+        for id_ in changed_ids:
+            child_ids = self.tree.is_branch(id_)
+            if child_ids:
+                branches.append(id_)
+                continue
+            pos = self.g.nodes[id_].get('pos')
+            if pos is None:
+                # Place new leaf at mean of positioned siblings, else at parent
+                parent  = self.tree.parent(id_)
+                x_list  = [self.g.nodes[el]['pos'][0] for el in self.tree.is_branch(parent.identifier)
+                           if 'pos' in self.g.nodes[el]] if parent else []
+                if x_list:
+                    pos = (sum(x_list)/len(x_list), 0)
+                elif parent and 'pos' in self.g.nodes[parent.identifier]:
+                    pos = self.g.nodes[parent.identifier]['pos']
+                else:
+                    pos = (0.5, 0)
+            self.g.nodes[id_]['pos'] = (pos[0], self.levels[id_]['n_a'])
+
+        for id_ in sorted(branches, key = lambda el: self.levels[el]['n_a']):
+            child_ids = self.tree.is_branch(id_)
+            x_list = [self.g.nodes[el]['pos'][0] for el in child_ids if 'pos' in self.g.nodes[el]]
+            x = sum(x_list)/len(x_list) if x_list else self.g.nodes[id_].get('pos', (0.5, 0))[0]
+            self.g.nodes[id_]['pos'] = (x, self.levels[id_]['n_a'])
+
+        # Update spatial index of positions
+        changed_ids = [el for el in changed_ids if el in self.g]
+        self.lattice_index.update(changed_ids, [self.g.nodes[el]['pos'][0] for el in changed_ids],
+                                  [self.g.nodes[el]['pos'][1] for el in changed_ids], removed_ids)
 
 
 
@@ -236,37 +2574,39 @@ class StepParse:
 
 
 
-    def create_tree(self):
+    def create_tree(self, depth = None):
 
         #TH: create tree diagram in newick format
         #TH: find root node
+        # Tree created down to "depth" levels (all if None, unless "max_tree_size" exceeded);
+        # assemblies below are left "unexpanded", standing in for their whole substructure
+        # in levels and lattice, until expanded via "expand_node"
 
-        self.tree = Tree()
+        self.tree = AssemblyTree()
+        #TH: create dict for tree, as each node needs a unique name
+        self.tree_dict  = {}
+        self._next_id   = None
+        # NAUO ref of each node except root, for patching tree on reload
+        self.node_nauo  = {}
+        self.unexpanded = set()
+        self.part_level = 1
+        self.tree_max_depth = depth
         #TH: check if there are any parts to make a tree from, if not don't bother
-        if self.part_dict == {}:
+        self.get_dag()
+        if not self.root_type_refs:
             return
 
         root_node_ref = list(self.root_type_refs)[0]
         # HR added part reference as data for later use
-        self.tree.create_node(self.part_dict[ root_node_ref ] , 0, data = {'ref': root_node_ref})
+        self.tree.create_node(self.get_name(root_node_ref), 0, data = {'ref': root_node_ref})
+        self.tree_dict[0] = root_node_ref
 
         #TH: created root node now fill in next layer
-        #TH: create dict for tree, as each node needs a unique name
-        i = [0] # Iterates through nodes
-        self.tree_dict = {}
-        self.tree_dict[i[0]] = root_node_ref
-
-        def tree_next_layer(self,parent):
-            root_node = self.tree_dict[i[0]]
-            for line in self.nauo_refs:
-                if line[1] == root_node:
-                    i[0] += 1
-                    self.tree_dict[i[0]] = str(line[2])
-                    # HR added part reference as data for later use
-                    self.tree.create_node( self.part_dict[line[2]], i[0] , parent=parent, data = {'ref': str(line[2])})
-                    tree_next_layer(self,i[0])
-
-        tree_next_layer(self,0)
+        # Nodes are created depth-first, so IDs are assigned in order NAUOs appear in file
+        if depth is None and self.max_tree_size:
+            depth = self.get_tree_depth(root_node_ref, self.max_tree_size)
+        self.unexpanded.add(0)
+        self.expand_node(0, depth)
         self.appended = False
 
         self.get_levels()
@@ -275,78 +2615,151 @@ class StepParse:
 
     def get_levels(self):
 
-        # Initialise dict and get first level (leaves)
-        self.levels = {}
-        self.levels_set_p = set()
-        self.levels_set_a = set()
-        self.leaf_ids     = [el.identifier for el in self.tree.leaves()]
-        self.all_ids      = [el for el in self.tree.nodes]
-        self.non_leaf_ids = set(self.all_ids) - set(self.leaf_ids)
-
+        # Get levels (n_p, n_a) of all nodes in one pass up tree, deepest nodes first,
+        # each node's levels being added to those of its parent
+        # ---
+        # Levels are also held in arrays "n_p" and "n_a" indexed by node ID, e.g. "n_p[id_]"
+        # is number of parts in subtree of node, via "get_part_counts"
         self.part_level = 1
-
-        def do_level(self, tree_level):
-            # Get all nodes within this level
-            node_ids = [el for el in self.tree.nodes if self.tree.level(el) == tree_level]
-            for el in node_ids:
-                # If leaf, then n_p = 1 and n_a = 1
-                if el in self.leaf_ids:
-                    self.levels[el] = {}
-                    self.levels[el]['n_p'] = self.part_level
-                    self.levels[el]['n_a'] = self.part_level
-                # If assembly, then get all children and sum all parts + assemblies
-                else:
-                    # Get all children of node and sum levels
-                    child_ids = self.tree.is_branch(el)
-                    child_sum_p = 0
-                    child_sum_a = 0
-                    for el_ in child_ids:
-                        child_sum_p += self.levels[el_]['n_p']
-                        child_sum_a += self.levels[el_]['n_a']
-                    self.levels[el] = {}
-                    self.levels[el]['n_p'] = child_sum_p
-                    self.levels[el]['n_a'] = child_sum_a + 1
-                    self.levels_set_p.add(child_sum_p)
-                    self.levels_set_a.add(child_sum_a + 1)
-
-        # Go up through tree levels and populate lattice level dict
-        for i in range(self.tree.depth(),-1,-1):
-            do_level(self, i)
+        parents = self.tree.get_parents()
+        depths  = self.tree.get_depths()
+        ids     = self.tree.get_ids()
+
+        # Unexpanded assemblies are not leaves (parts) although they have no children in tree
+        unexpanded = np.array(sorted(self.unexpanded), dtype = np.int64)
+        is_leaf = np.zeros(len(parents), dtype = bool)
+        is_leaf[self.tree.get_leaf_ids()] = True
+        is_leaf[unexpanded] = False
+        # Held as sets, so updated per node after edits, see "update_levels"
+        self.leaf_ids     = set(np.flatnonzero(is_leaf).tolist())
+        self.all_ids      = set(ids.tolist())
+        self.non_leaf_ids = self.all_ids - self.leaf_ids
+
+        # Leaves are parts, unexpanded assemblies take levels of full substructure
+        # and others count themselves plus children, added below
+        self.n_p = np.zeros(len(parents), dtype = np.int64)
+        self.n_a = np.zeros(len(parents), dtype = np.int64)
+        self.n_p[is_leaf] = self.part_level
+        self.n_a[ids]     = self.part_level
+        for el in unexpanded.tolist():
+            self.n_p[el], self.n_a[el] = self.get_leaf_levels(el)
+
+        # Order nodes deepest first, then by ID, and add each depth to parents in turn
+        ids        = ids[np.lexsort((ids, -depths[ids]))]
+        boundaries = np.flatnonzero(np.diff(depths[ids])) + 1
+        for level_ids in np.split(ids, boundaries):
+            level_parents = parents[level_ids]
+            level_ids     = level_ids[level_parents >= 0]
+            level_parents = level_parents[level_parents >= 0]
+            np.add.at(self.n_p, level_parents, self.n_p[level_ids])
+            np.add.at(self.n_a, level_parents, self.n_a[level_ids])
+
+        self.levels = {k:{'n_p': p, 'n_a': a} for k, p, a in zip(ids.tolist(), self.n_p[ids].tolist(), self.n_a[ids].tolist())}
+
+        self.count_levels()
+        self.tree.track_changes()
 
         self.create_lattice()
         
+        self.get_levels_inv()
+
+
+
+    def count_levels(self):
+
+        # Get numbers of nodes at each lattice level, and so level sets
+        # Lattice levels are those of assemblies, including unexpanded ones, i.e. nodes with n_a > 1
+        ids    = self.tree.get_ids()
+        in_set = ids[self.n_a[ids] != self.part_level]
+        self.levels_count_p = dict(zip(*(el.tolist() for el in np.unique(self.n_p[in_set], return_counts = True))))
+        self.levels_count_a = dict(zip(*(el.tolist() for el in np.unique(self.n_a[in_set], return_counts = True))))
+        self.levels_set_p   = set(self.levels_count_p)
+        self.levels_set_a   = set(self.levels_count_a)
+
+
+
+    def set_level_arrays(self):
+
+        # Get "n_p" and "n_a" arrays from "levels", e.g. after restoring from cache
+        size     = len(self.tree.get_parents())
+        self.n_p = np.zeros(size, dtype = np.int64)
+        self.n_a = np.zeros(size, dtype = np.int64)
+        for k, v in self.levels.items():
+            self.n_p[k] = v['n_p']
+            self.n_a[k] = v['n_a']
+
+
+
+    def get_part_counts(self, ids = None):
+
+        # Get numbers of parts in subtrees of nodes with given IDs (all nodes if None), as array
+        if ids is None:
+            ids = self.tree.get_ids()
+        return self.n_p[ids]
+
+
+
+    def get_levels_inv(self):
+
         self.levels_p_sorted = sorted(list(self.levels_set_p))
         self.levels_a_sorted = sorted(list(self.levels_set_a))
         
-        # Function to return dictionary of item IDs for each lattice level
-        def get_levels_inv(list_in, key):
+        # Node IDs in order of "levels", grouped by level via stable sort of level arrays
+        ids = np.fromiter(self.levels, dtype = np.int64, count = len(self.levels))
+
+        # Function to return dictionary of sets of item IDs for each lattice level
+        # Sets rather than lists, so IDs removed in constant time after edits
+        def get_levels_inv(list_in, values):
             
             #Initialise
             levels_inv = {}
-            levels_inv[self.part_level] = []
+            levels_inv[self.part_level] = set()
             for el in list_in:
-                levels_inv[el] = []
-            for k,v in self.levels.items():
-                levels_inv[v[key]].append(k)             
+                levels_inv[el] = set()
+            values = values[ids]
+            order  = np.argsort(values, kind = 'stable')
+            values = values[order]
+            starts = np.flatnonzero(np.r_[True, values[1:] != values[:-1]])
+            for value, group in zip(values[starts].tolist(), np.split(ids[order], starts[1:])):
+                levels_inv[value] = set(group.tolist())
             
             return levels_inv
         
-        self.levels_p_inv = get_levels_inv(self.levels_p_sorted, 'n_p')
-        self.levels_a_inv = get_levels_inv(self.levels_a_sorted, 'n_a')
+        self.levels_p_inv = get_levels_inv(self.levels_p_sorted, self.n_p)
+        self.levels_a_inv = get_levels_inv(self.levels_a_sorted, self.n_a)
+
+
+
+    def get_leaf_levels(self, id_):
+
+        # Get (n_p, n_a) of leaf node in tree
+        # Leaves standing in for unexpanded assemblies take levels of full substructure
+        if id_ in self.unexpanded:
+            return self.get_dag_levels(self.tree_dict[id_])
+        return self.part_level, self.part_level
 
 
 
     def get_all_children(self, id_):
-        
-        ancestors = [el.identifier for el in self.tree.children(id_)]
-        parents = ancestors
-        while parents:
-            children = []
-            for parent in parents:
-                children = [el.identifier for el in self.tree.children(parent)]
-                ancestors.extend(children)
-                parents = children
-        return ancestors
+
+        # Get IDs of all descendants of node, from subtree index
+        return self.tree.get_descendant_ids(id_).tolist()
+
+
+
+    def compare(self, other, key = 'tag'):
+
+        # Compare tree with that of other assembly, e.g. alternative configuration of same parts,
+        # see "AssemblyComparison"
+        return AssemblyComparison(self.tree, other.tree, key)
+
+
+
+    def get_part_lattice(self):
+
+        # Get Boolean lattice of parts of current tree, with each node as bitset of its parts,
+        # see "PartLattice"
+        return PartLattice(self.tree)
     
 
 
@@ -355,68 +2768,408 @@ class StepParse:
         # Create lattice
         self.g = nx.DiGraph()
         self.default_colour = 'r'
-        # Get root node and set parent to -1 to maintain data type of "parent"
-        # Set position to top/middle
-        node_id    = self.tree.root
-        label_text = self.tree.get_node(node_id).tag
-        self.g.add_node(node_id, parent = -1, label = label_text, colour = self.default_colour)
-
-        # Do nodes from treelib "nodes" dictionary
-        for key in self.tree.nodes:
-            # Exclude root
-            if key != self.tree.root:
-                parent_id  = self.tree.parent(key).identifier
-                label_text = self.tree.get_node(key).tag
-                # Node IDs same as for tree
-                self.g.add_node(key, parent = parent_id, label = label_text, colour = self.default_colour)
-
-        # Do edges from nodes
-        for key in self.tree.nodes:
-            # Exclude root
-            if key != self.tree.root:
-                parent_id = self.tree.parent(key).identifier
-                self.g.add_edge(key, parent_id)
+        # Node IDs same as for tree, root first; parent of root set to -1 to maintain data type of "parent"
+        ids = self.tree.get_ids()
+        if self.tree.root is not None:
+            ids = np.concatenate(([self.tree.root], ids[ids != self.tree.root]))
+        parents = self.tree.get_parents()[ids]
+        tags    = self.tree.get_tags(ids)
+        ids     = ids.tolist()
+        self.g.add_nodes_from((id_, {'parent': parent, 'label': tag, 'colour': self.default_colour})
+                              for id_, parent, tag in zip(ids, parents.tolist(), tags))
+
+        # Do edges from nodes, excluding root
+        self.g.add_edges_from((id_, parent) for id_, parent in zip(ids, parents.tolist()) if parent >= 0)
+
+        self.set_lattice_positions()
+
+
+
+    def get_lattice_positions(self):
+
+        # Get lattice positions as arrays (ids, x, y), computed on tree arrays:
+        # leaves spaced evenly in x, grouped by parent, and each assembly at mean x of its children;
+        # y is number of assemblies n_a
+        # ---
+        # Leaf order is as originally laid out, i.e. by parent in order of set of leaf parents,
+        # then by order of children
+        parents = self.tree.get_parents()
+        ids     = self.tree.get_ids()
 
         # Escape if only one node
-        # HR 6/3/20 QUICK BUG FIX: SINGLE-NODE TREE DOES NOT PLOT
-        # IMPROVE LATER; SHOULD BE PART OF A GENERAL METHOD
-        if self.tree.size() == 1:
-            id_ = [el.identifier for el in self.tree.leaves()]
-            self.g.nodes[id_[-1]]['pos'] = (0,0)
+        if len(ids) == 1:
+            return ids, np.zeros(1), np.zeros(1, dtype = np.int64)
+
+        # Leaves include unexpanded assemblies, which are positioned as leaves
+        leaf_ids     = self.tree.get_leaf_ids()
+        leaf_parents = list(set(parents[leaf_ids].tolist()))
+        rank         = np.zeros(len(parents), dtype = np.int64)
+        rank[leaf_parents] = np.arange(len(leaf_parents))
+        leaf_ids = leaf_ids[np.lexsort((self.tree._seq[leaf_ids], rank[parents[leaf_ids]]))]
+
+        return ids, self.get_mean_x(leaf_ids)[ids], self.n_a[ids]
+
+
+
+    def get_mean_x(self, leaf_ids):
+
+        # Get x of all nodes, indexed by node ID, with leaves spaced evenly in given order
+        # and each assembly at mean x of its children
+        # ---
+        # Traverses upwards from deepest nodes; all children of assembly are one level deeper,
+        # so are positioned before it
+        parents = self.tree.get_parents()
+        depths  = self.tree.get_depths()
+        ids     = self.tree.get_ids()
+        x       = np.zeros(len(parents))
+        x[leaf_ids] = np.arange(len(leaf_ids))/len(leaf_ids)
+
+        is_leaf = np.zeros(len(parents), dtype = bool)
+        is_leaf[leaf_ids] = True
+        order      = ids[np.argsort(-depths[ids], kind = 'stable')]
+        boundaries = np.flatnonzero(np.diff(depths[order])) + 1
+        x_sum      = np.zeros(len(parents))
+        counts     = np.zeros(len(parents), dtype = np.int64)
+        for level_ids in np.split(order, boundaries):
+            level_branches = level_ids[~is_leaf[level_ids]]
+            x[level_branches] = x_sum[level_branches]/counts[level_branches]
+            level_ids = level_ids[parents[level_ids] >= 0]
+            np.add.at(x_sum, parents[level_ids], x[level_ids])
+            np.add.at(counts, parents[level_ids], 1)
+
+        return x
+
+
+
+    def get_layered_positions(self, method = 'barycentre', sweeps = None):
+
+        # Get lattice positions as arrays (ids, x, y), as "get_lattice_positions" but with
+        # children of each assembly reordered to reduce edge crossings between lattice levels
+        # ---
+        # Layered crossing reduction: edges are split at each level they pass (see "get_edge_pieces"),
+        # so every level holds nodes and dummy items on longer edges; each sweep orders levels
+        # top-down by position of item above, then bottom-up by "barycentre" (mean) or "median"
+        # position of items below, positions being ranks within level, held as sparse matrix
+        # of items below each item
+        # ---
+        # Children of each assembly are then ordered as their items on level below it, leaves laid out
+        # again depth-first and crossings counted (see "count_crossings"); new layout kept only
+        # if it has fewer crossings, each sweep starting from best layout so far, else sweeps stop
+        # Too many pieces to count keeps layout of "get_lattice_positions"
+        if sparse is None:
+            raise ImportError('SciPy needed for layered lattice layout')
+        if method not in ('barycentre', 'median'):
+            raise ValueError('Unknown layout method: %s' % method)
+        if sweeps is None:
+            sweeps = self.layout_sweeps
+
+        ids, x, y = self.get_lattice_positions()
+        if len(ids) == 1:
+            return ids, x, y
+        pieces = self.get_edge_pieces(ids, y)
+        if pieces is None:
+            return ids, x, y
+
+        edges, bands, _, _ = pieces
+        parents  = self.tree.get_parents()
+        size     = len(parents)
+        n_levels = len(np.unique(y))
+        roots    = ids[parents[ids] < 0]
+        first    = np.r_[True, edges[1:] != edges[:-1]]
+        last     = np.r_[first[1:], True]
+
+        # Items are bottom ends of pieces, i.e. child for first piece of edge, else dummy,
+        # then roots; numbered by level so each level is contiguous range of items
+        item_levels = np.r_[bands, np.full(len(roots), n_levels - 1)]
+        order       = np.argsort(item_levels, kind = 'stable')
+        numbers     = np.empty(len(order), dtype = np.int64)
+        numbers[order] = np.arange(len(order))
+        item_levels = item_levels[order]
+        starts      = np.searchsorted(item_levels, np.arange(n_levels + 1))
+        ranks       = np.arange(len(order)) - starts[item_levels]
+        widths      = np.diff(starts)[item_levels]
+
+        # Each piece joins item at its bottom to that at bottom of next piece or, for last piece
+        # of edge, to parent's item; each child is then placed among siblings by its last item
+        lower = numbers[:len(edges)]
+        node_items = np.zeros(size, dtype = np.int64)
+        node_items[edges[first]] = lower[first]
+        node_items[roots]        = numbers[len(edges):]
+        upper = np.r_[lower[1:], 0]
+        upper[last] = node_items[parents[edges[last]]]
+        child_items = np.zeros(size, dtype = np.int64)
+        child_items[edges[last]] = lower[last]
+
+        above = np.full(len(order), -1)
+        above[lower] = upper
+        below   = sparse.csr_matrix((np.ones(len(edges)), (upper, lower)), shape = (len(order), len(order)))
+        n_below = np.diff(below.indptr)
+
+        x_all = np.zeros(size)
+        x_all[ids] = x
+        best      = self.count_crossings(x_all, pieces)
+        positions = np.zeros(len(order))
+        for i in range(sweeps):
+            if best == 0:
+                break
+
+            # Items in order of x within levels in best layout so far
+            x_lo, _ = self.get_piece_x(x_all, pieces)
+            item_x  = np.r_[x_lo, x_all[roots]][order]
+            positions[np.lexsort((item_x, item_levels))] = (ranks + 0.5)/widths
+
+            for level in range(n_levels - 2, -1, -1):
+                lo, hi = starts[level], starts[level + 1]
+                key = positions[above[lo:hi]]
+                positions[lo + np.lexsort((positions[lo:hi], key))] = (np.arange(hi - lo) + 0.5)/(hi - lo)
+
+            for level in range(1, n_levels):
+                lo, hi = starts[level], starts[level + 1]
+                rows = below[lo:hi]
+                n    = n_below[lo:hi]
+                has_below = n > 0
+                key = positions[lo:hi].copy()
+                if method == 'barycentre':
+                    key[has_below] = (rows @ positions)[has_below]/n[has_below]
+                else:
+                    values = positions[rows.indices]
+                    values = values[np.lexsort((values, np.repeat(np.arange(hi - lo), n)))]
+                    row_starts = rows.indptr[:-1][has_below]
+                    n = n[has_below]
+                    key[has_below] = (values[row_starts + (n - 1)//2] + values[row_starts + n//2])/2
+                positions[lo + np.lexsort((positions[lo:hi], key))] = (np.arange(hi - lo) + 0.5)/(hi - lo)
+
+            new_x     = self.get_mean_x(self.get_leaf_order(positions[child_items]))
+            crossings = self.count_crossings(new_x, pieces)
+            if crossings >= best:
+                break
+            best  = crossings
+            x_all = new_x
+
+        return ids, x_all[ids], y
+
+
+
+    def get_leaf_order(self, key):
+
+        # Get leaf IDs in depth-first order, with children of each assembly ordered by key,
+        # indexed by node ID, then by ID
+        # ---
+        # Each node enters depth-first order after its parent and subtrees of preceding siblings,
+        # found level by level down from root with sizes of subtrees summed up levels
+        parents  = self.tree.get_parents()
+        depths   = self.tree.get_depths()
+        ids      = self.tree.get_ids()
+        leaf_ids = self.tree.get_leaf_ids()
+        size     = len(parents)
+
+        order  = ids[np.argsort(depths[ids], kind = 'stable')]
+        levels = np.split(order, np.flatnonzero(np.diff(depths[order])) + 1)
+        tsize  = np.zeros(size, dtype = np.int64)
+        tsize[ids] = 1
+        for level in reversed(levels[1:]):
+            np.add.at(tsize, parents[level], tsize[level])
+
+        child_ids = ids[parents[ids] >= 0]
+        siblings  = child_ids[np.lexsort((child_ids, key[child_ids], parents[child_ids]))]
+        sizes     = tsize[siblings]
+        before    = np.cumsum(sizes) - sizes
+        starts    = np.flatnonzero(np.r_[True, parents[siblings][1:] != parents[siblings][:-1]])
+        first     = np.repeat(starts, np.diff(np.r_[starts, len(siblings)]))
+        offsets   = np.zeros(size, dtype = np.int64)
+        offsets[siblings] = before - before[first]
+        tin = np.zeros(size, dtype = np.int64)
+        for level in levels[1:]:
+            tin[level] = tin[parents[level]] + 1 + offsets[level]
+
+        return leaf_ids[np.argsort(tin[leaf_ids])]
+
+
+
+    def get_edge_pieces(self, ids, y):
+
+        # Split lattice edges at every level they pass, for positions (ids, x, y) with y as given,
+        # as arrays (edges, bands, t_lo, t_hi) with one entry per piece: child ID of edge,
+        # index of level at bottom of piece and fractions of edge's height at bottom and top;
+        # None if more pieces than "layout_max_pieces"
+        # ---
+        # Pieces of each edge are consecutive, from bottom; parent is always on higher level than child
+        parents = self.tree.get_parents()
+        y_all   = np.zeros(len(parents))
+        y_all[ids] = y
+        levels  = np.unique(y)
+        layers  = np.searchsorted(levels, y_all)
+
+        children = ids[parents[ids] >= 0]
+        spans    = layers[parents[children]] - layers[children]
+        n_pieces = int(spans.sum())
+        if n_pieces > self.layout_max_pieces:
+            return None
+
+        edges  = np.repeat(children, spans)
+        bands  = layers[edges] + np.arange(n_pieces) - np.repeat(np.cumsum(spans) - spans, spans)
+        y_0    = y_all[edges]
+        height = y_all[parents[edges]] - y_0
+        return edges, bands, (levels[bands] - y_0)/height, (levels[bands + 1] - y_0)/height
+
+
+
+    def get_piece_x(self, x, pieces):
+
+        # Get x at bottom and top of edge pieces from "get_edge_pieces", with x indexed by node ID
+        # Ends of edges are exact, so edges meeting at node meet in pieces too
+        edges, _, t_lo, t_hi = pieces
+        x_child  = x[edges]
+        x_parent = x[self.tree.get_parents()[edges]]
+        return x_child*(1 - t_lo) + x_parent*t_lo, x_child*(1 - t_hi) + x_parent*t_hi
+
+
+
+    def count_crossings(self, x, pieces):
+
+        # Count crossings of straight lattice edges, with x indexed by node ID,
+        # from edge pieces given by "get_edge_pieces"
+        # ---
+        # Tops of pieces are ranked within band, equal x sharing rank, so pieces meeting at top
+        # don't count; ranks increase with band, so pieces in different bands never count
+        edges, bands, _, _ = pieces
+        if len(edges) < 2:
+            return 0
+        x_lo, x_hi = self.get_piece_x(x, pieces)
+        order = np.lexsort((x_hi, bands))
+        new   = np.r_[True, (np.diff(bands[order]) != 0) | (np.diff(x_hi[order]) != 0)]
+        ranks = np.empty(len(edges), dtype = np.int64)
+        ranks[order] = np.cumsum(new) - 1
+        return count_inversions(ranks[np.lexsort((x_hi, x_lo, bands))])
+
+
+
+    def get_crossings(self, positions = None):
+
+        # Count crossings of straight lattice edges for positions (ids, x, y), by default
+        # from "get_layout"; None if too many edge pieces, see "get_edge_pieces"
+        ids, x, y = self.get_layout() if positions is None else positions
+        pieces = self.get_edge_pieces(ids, y)
+        if pieces is None:
+            return None
+        x_all = np.zeros(len(self.tree.get_parents()))
+        x_all[ids] = x
+        return self.count_crossings(x_all, pieces)
+
+
+
+    def get_layout(self):
+
+        # Get lattice positions (ids, x, y) from "get_lattice_positions" or,
+        # if "layout" is "barycentre" or "median", "get_layered_positions"
+        if self.layout in ('barycentre', 'median') and sparse is not None:
+            return self.get_layered_positions(self.layout)
+        return self.get_lattice_positions()
+
+
+
+    def get_layout_snapshot(self):
+
+        # Get copy of assembly with own tree and levels, on which "get_layout" can be run
+        # in another thread while assembly is edited; everything else is shared, so must not be used
+        snapshot      = copy.copy(self)
+        snapshot.tree = self.tree.copy()
+        snapshot.n_p  = self.n_p.copy()
+        snapshot.n_a  = self.n_a.copy()
+        return snapshot
+
+
+
+    def set_lattice_positions(self, positions = None):
+
+        # Set "pos" attribute of all lattice nodes, from "get_layout" or from "positions" given
+        # as returned by it, e.g. from snapshot (see "get_layout_snapshot") if tree not since edited;
+        # positions are also indexed for picking nodes, see "LatticeIndex"
+        ids, x, y = self.get_layout() if positions is None else positions
+        if len(ids) == 1:
+            self.g.nodes[ids[0]]['pos'] = (0,0)
+            self.lattice_index = LatticeIndex(ids, [0], [0])
             return
-        
+        nx.set_node_attributes(self.g, dict(zip(ids.tolist(), zip(x.tolist(), y.tolist()))), 'pos')
+        self.lattice_index = LatticeIndex(ids, x, y)
+
 
-        # Get set of parents of leaf nodes
-        leaf_parents = set([self.tree.parent(el).identifier for el in self.leaf_ids])
 
-        # For each leaf_parent, set position of leaf nodes sequentially
-        i = 0
-        no_leaves = len(self.tree.leaves())
-        for el in leaf_parents:
-            for el_ in self.tree.is_branch(el):
-                child_ids = [el.identifier for el in self.tree.leaves()]
-                if el_ in child_ids:
-                    self.g.nodes[el_]['pos'] = ((i/(no_leaves)),1)
-                    i += 1
+    def get_lattice_detail(self, max_parts, rect = None, max_nodes = None):
 
-        # To set plot positions of nodes from lattice levels
+        # Get nodes and edges to draw for level-of-detail view of lattice, as
+        # (ids, x, y, collapsed, segments, max_parts): sub-assemblies of at most "max_parts" parts
+        # (n_p) are collapsed, i.e. drawn as single node with descendants hidden, "collapsed" being
+        # true for those; only nodes within "rect" (x_0, y_0, x_1, y_1) are included, if given,
+        # with edges that may cross it, as array of ((x, y), (x_parent, y_parent))
         # ---
-        # Traverse upwards from leaves
-        for el in sorted(list(self.levels_set_a)):
-            # Get all nodes at that level
-            node_ids = [k for k,v in self.levels.items() if v['n_a'] == el]
-            # Get all positions of children of that node
-            # and set position as mean value of them
-            for el_ in node_ids:
-                child_ids = self.tree.is_branch(el_)
-                pos_sum = 0
-                for el__ in child_ids:
-                    pos_    = self.g.nodes[el__]['pos'][0]
-                    pos_sum += pos_
-                pos_sum = pos_sum/len(child_ids)
-                self.g.nodes[el_]['pos'] = (pos_sum, el)
+        # If more than "max_nodes" nodes would be drawn, "max_parts" is raised so that no more are
+
+        # Arrays depending only on layout and levels are kept until positions next change
+        index = self.lattice_index
+        if self.detail_arrays is None or self.detail_arrays[0] is not index.ids:
+            parents = self.tree.get_parents()
+            p       = parents[index.ids]
+            is_root = p < 0
+            has_children = np.zeros(len(parents), dtype = bool)
+            has_children[p[~is_root]] = True
+            # Node is shown if its parent is not collapsed, as then no ancestor is collapsed
+            parent_parts = np.where(is_root, np.iinfo(np.int64).max, self.n_p[np.where(is_root, 0, p)])
+            x_all = np.zeros(len(parents))
+            y_all = np.zeros(len(parents))
+            x_all[index.ids] = index.x
+            y_all[index.ids] = index.y
+            self.detail_arrays = (index.ids, is_root, has_children[index.ids], np.isin(index.ids, list(self.unexpanded)),
+                                  self.n_p[index.ids], parent_parts,
+                                  x_all[np.where(is_root, 0, p)], y_all[np.where(is_root, 0, p)])
+        ids, is_root, has_children, is_unexpanded, n_p, parent_parts, x_parent, y_parent = self.detail_arrays
+        x, y = index.x, index.y
+
+        if rect is None:
+            in_rect = np.ones(len(ids), dtype = bool)
+        else:
+            x_0, y_0, x_1, y_1 = rect
+            in_rect = (x >= min(x_0, x_1)) & (x <= max(x_0, x_1)) & (y >= min(y_0, y_1)) & (y <= max(y_0, y_1))
+        if max_nodes is not None and np.count_nonzero(in_rect) > max_nodes:
+            values    = parent_parts[in_rect]
+            max_parts = max(max_parts, int(np.partition(values, len(values) - max_nodes)[len(values) - max_nodes]))
+        shown = parent_parts > max_parts
+
+        # Unexpanded assemblies are always drawn as collapsed
+        drawn     = shown & in_rect
+        collapsed = (has_children & (n_p <= max_parts)) | is_unexpanded
+
+        # Edges of shown nodes whose bounding box meets "rect"
+        edges    = shown & ~is_root
+        x_e, y_e = x[edges], y[edges]
+        x_p, y_p = x_parent[edges], y_parent[edges]
+        if rect is not None:
+            meets = ((np.minimum(x_e, x_p) <= max(x_0, x_1)) & (np.maximum(x_e, x_p) >= min(x_0, x_1)) &
+                     (np.minimum(y_e, y_p) <= max(y_0, y_1)) & (np.maximum(y_e, y_p) >= min(y_0, y_1)))
+            x_e, y_e, x_p, y_p = x_e[meets], y_e[meets], x_p[meets], y_p[meets]
+        segments = np.stack((np.stack((x_e, y_e), axis = 1), np.stack((x_p, y_p), axis = 1)), axis = 1)
+
+        return ids[drawn], x[drawn], y[drawn], collapsed[drawn], segments, max_parts
+
+
+
+    def get_level_stats(self):
+
+        # Summary statistics of tree and lattice levels, e.g. for batch processing
+        # Level counts are numbers of nodes with each value of n_p/n_a
+        count_p = {}
+        count_a = {}
+        for v in self.levels.values():
+            count_p[v['n_p']] = count_p.get(v['n_p'], 0) + 1
+            count_a[v['n_a']] = count_a.get(v['n_a'], 0) + 1
+        return {'n_nodes':      self.tree.size(),
+                'n_parts':      len(self.leaf_ids),
+                'n_assemblies': len(self.non_leaf_ids),
+                'depth':        self.tree.depth(),
+                'levels_p':     {str(k):count_p[k] for k in sorted(count_p)},
+                'levels_a':     {str(k):count_a[k] for k in sorted(count_a)}}
+
 
-        
 
     def print_tree(self):
 
@@ -447,3 +3200,262 @@ class StepParse:
         else:
             print("no tree to print")
             return
+
+
+
+class LazyStepParse(StepParse):
+
+    # Variant of StepParse for very large files
+    # ---
+    # Loading only indexes product-structure entities by file offset (see "entities");
+    # NAUO relationships are parsed when tree is first created, product names when nodes
+    # are created, and tree nodes only down to given depth, the rest being added
+    # via "expand_node", e.g. when expanded in parts view
+    # ---
+    # Unexpanded nodes are handled as for StepParse with "max_tree_size" set
+
+
+
+    def load(self, step_filename, cache = None, depth = 2, cancel = None, **kwargs):
+
+        # As StepParse.load but tree created only to "depth"; not cached
+        self.load_step(step_filename, **kwargs)
+        if cancel is not None and cancel.is_set():
+            self.close()
+            raise LoadCancelled()
+        self.create_tree(depth)
+
+
+
+    def load_step(self, step_filename, **kwargs):
+
+        # Index product-structure entities in memory-mapped file
+        self.filename      = get_step_basename(step_filename)
+        self.step_filename = step_filename
+        self.close()
+        if is_compressed(step_filename):
+            raise ValueError('Compressed STEP file cannot be loaded lazily: ' + step_filename)
+        self.entities      = {}
+        self.part_dict     = {}
+        self.dangling_refs = []
+        self.nauo_refs     = None
+        self.dag           = None
+        with open(step_filename, 'rb') as f:
+            if not os.fstat(f.fileno()).st_size:
+                return
+            self.buffer = mmap.mmap(f.fileno(), 0, access = mmap.ACCESS_READ)
+        try:
+            for id_, type_, start, end, args in iter_entities(self.buffer, types = STEP_TYPES,
+                                                              progress = kwargs.get('progress')):
+                self.entities['#' + id_.decode()] = (type_.decode(), start, end)
+        except BaseException:
+            self.close()
+            raise
+
+
+
+    def get_entity_refs(self, ref):
+
+        # Get all "#" refs in arguments of indexed entity
+        type_, start, end = self.entities[ref]
+        return get_refs(self.buffer[start:end])
+
+
+
+    def get_dag(self):
+
+        # Parse all NAUO entities on first call
+        if self.nauo_refs is None:
+            self.nauo_refs = [[ref] + self.get_entity_refs(ref) for ref, (type_, start, end) in self.entities.items()
+                              if STEP_TYPES[type_.encode()] == 'nauo']
+            self.get_type_refs()
+        return super().get_dag()
+
+
+
+    def get_name(self, ref):
+
+        # Resolve product definition ref -> formation -> product -> name, on first call only
+        if ref in self.part_dict:
+            return self.part_dict[ref]
+        name = None
+        try:
+            prod_form_ref = self.get_entity_refs(ref)[0]
+            prod_ref      = self.get_entity_refs(prod_form_ref)[0]
+            type_, start, end = self.entities[prod_ref]
+            name = get_first_string(self.buffer[start:end])
+        except (KeyError, IndexError) as e:
+            self.dangling_refs.append((ref, e.args[0] if isinstance(e, KeyError) else None))
+            print('Warning: cannot resolve name of %s' % ref)
+            name = ref
+        self.part_dict[ref] = name
+        return name
+
+
+
+    def create_tree(self, depth = 2):
+
+        # Create tree only down to "depth"
+        super().create_tree(depth)
+
+
+
+### ---
+# Batch processing from command line
+# ---
+# e.g. python -m step_parse_5_2 "archive/**/*.stp" --out trees --jobs 8 --timeout 600
+# Each file is loaded in a worker process; tree JSON (as "tree_to_json") and level statistics
+# are written to output folder and a tab-separated summary line is printed per file as done:
+# [progress] status  time (s)  nodes  parts  depth  file
+### ---
+
+# File extensions found when searching folders
+STEP_EXTS = ('.stp', '.step', '.p21', '.stpz', '.stp.gz', '.step.gz')
+
+
+
+def find_step_files(paths):
+
+    # Expand files, glob patterns and folders (searched recursively) into list of STEP files
+    filenames = []
+    for path in paths:
+        if os.path.isdir(path):
+            for folder, dirs, files in os.walk(path):
+                filenames.extend(os.path.join(folder, el) for el in sorted(files) if el.lower().endswith(STEP_EXTS))
+        elif os.path.isfile(path):
+            filenames.append(path)
+        else:
+            filenames.extend(sorted(el for el in glob.glob(path, recursive = True) if os.path.isfile(el)))
+    # Remove duplicates, preserving order
+    return list(dict.fromkeys(filenames))
+
+
+
+def get_output_names(filenames):
+
+    # Get unique output file names (without extension) for input files, as paths relative to folder
+    # containing all of them, so that files of same name in different folders are kept apart;
+    # extension is kept for files whose names differ only in extension, e.g. "a.stp" and "a.step"
+    paths  = [os.path.abspath(el) for el in filenames]
+    folder = os.path.commonpath([os.path.dirname(el) for el in paths])
+    paths  = [os.path.relpath(el, folder) for el in paths]
+    names  = [get_step_basename(el) for el in paths]
+    counts = {}
+    for name in names:
+        counts[name] = counts.get(name, 0) + 1
+    return [name if counts[name] == 1 else path for name, path in zip(names, paths)]
+
+
+
+class FileTimeout(Exception):
+    pass
+
+
+
+def _on_alarm(signum, frame):
+    raise FileTimeout()
+
+
+
+def process_file(step_filename, out_path, out_name, timeout = None, use_mmap = False):
+
+    # Load STEP file, write tree JSON and level statistics (worker function)
+    # "out_name" may include sub-folders of "out_path", which are created if needed
+    # Returns summary dictionary with "status" of "ok", "empty", "timeout" or "error"
+    summary = {'file': step_filename, 'status': 'ok', 'time': 0.0}
+    start   = time.perf_counter()
+    # Timeout only enforced where alarm signal available (i.e. not Windows)
+    alarm = timeout and hasattr(signal, 'SIGALRM')
+    if alarm:
+        signal.signal(signal.SIGALRM, _on_alarm)
+        signal.alarm(int(max(1, timeout)))
+    try:
+        assembly = StepParse()
+        assembly.load_step(step_filename, use_mmap = use_mmap)
+        assembly.create_tree()
+        if assembly.tree.size():
+            os.makedirs(os.path.dirname(os.path.join(out_path, out_name)), exist_ok = True)
+            assembly.tree_to_json(save_to_file = True, filename = out_name, path = out_path)
+            stats = assembly.get_level_stats()
+            with open(os.path.join(out_path, out_name + '.levels.json'), 'w') as f:
+                json.dump(stats, f)
+            summary.update(stats)
+        else:
+            summary['status'] = 'empty'
+        assembly.close()
+    except FileTimeout:
+        summary['status'] = 'timeout'
+    except Exception as e:
+        summary['status']  = 'error'
+        summary['message'] = '%s: %s' % (type(e).__name__, e)
+    finally:
+        if alarm:
+            signal.alarm(0)
+    summary['time'] = time.perf_counter() - start
+    return summary
+
+
+
+def main(argv = None):
+
+    # Command-line entry point
+    parser = argparse.ArgumentParser(description = 'Parse product structure of STEP files, writing tree JSON '
+                                                   'and level statistics per file')
+    parser.add_argument('paths', nargs = '+', help = 'STEP files, glob patterns or folders')
+    parser.add_argument('--out', default = '.', help = 'output folder (default: current folder)')
+    parser.add_argument('--jobs', type = int, default = None,
+                        help = 'number of files processed in parallel (default: number of cores)')
+    parser.add_argument('--timeout', type = float, default = None, help = 'time limit per file in seconds')
+    parser.add_argument('--workers', type = int, default = None,
+                        help = 'number of processes for parallel parsing of single large file, with --show')
+    parser.add_argument('--mmap', action = 'store_true', help = 'memory-map files and decode names on demand')
+    parser.add_argument('--show', action = 'store_true', help = 'print tree of single file instead')
+    args = parser.parse_args(argv)
+    # Files are already processed in parallel in batch mode, see "--jobs"
+    if args.workers and not args.show:
+        parser.error('--workers only applies with --show; use --jobs to process files in parallel')
+
+    filenames = find_step_files(args.paths)
+    if not filenames:
+        print('No STEP files found')
+        return 1
+
+    if args.show:
+        assembly = StepParse()
+        assembly.load_step(filenames[0], use_mmap = args.mmap, workers = args.workers)
+        assembly.create_tree()
+        assembly.print_tree()
+        assembly.close()
+        return 0
+
+    os.makedirs(args.out, exist_ok = True)
+    out_names = get_output_names(filenames)
+    n_files   = len(filenames)
+    counts    = {}
+    start     = time.perf_counter()
+    with ProcessPoolExecutor(max_workers = args.jobs) as executor:
+        futures = [executor.submit(process_file, filename, args.out, out_name, args.timeout, args.mmap)
+                   for filename, out_name in zip(filenames, out_names)]
+        for i, future in enumerate(as_completed(futures)):
+            try:
+                summary = future.result()
+            except Exception as e:
+                # e.g. worker process killed
+                summary = {'file': filenames[futures.index(future)], 'status': 'error', 'time': 0.0,
+                           'message': '%s: %s' % (type(e).__name__, e)}
+            counts[summary['status']] = counts.get(summary['status'], 0) + 1
+            line = '[%i/%i]\t%s\t%.3f\t%s\t%s\t%s\t%s' % (i + 1, n_files, summary['status'], summary['time'],
+                                                           summary.get('n_nodes', ''), summary.get('n_parts', ''),
+                                                           summary.get('depth', ''), summary['file'])
+            if 'message' in summary:
+                line += '\t' + summary['message']
+            print(line, flush = True)
+
+    print('Done: %i files in %.1f s (%s)' % (n_files, time.perf_counter() - start,
+                                             ', '.join('%i %s' % (v, k) for k, v in sorted(counts.items()))))
+    return 0 if counts.get('ok', 0) + counts.get('empty', 0) == n_files else 1
+
+
+
+if __name__ == '__main__':
+    sys.exit(main())